@@ -8,16 +8,32 @@
       * options.username
       * options.password
 """
+import datetime
 import email
 import email.utils
-from email.header import decode_header
+import json
 import optparse
 import os
 import mailbox
+import queue
+import socket
+import sqlite3
 import sys
+import threading
+import time
 
 import imapclient
-from pyzmail import parse
+
+from lcutil.util_email import MaildirIndex, email_metadata
+
+# Incremental dump state, per folder, kept in the Maildir.
+STATE_FILENAME = '.imap_tool_state.json'
+
+# Full text index of a dump, kept in the Maildir.
+INDEX_FILENAME = '.imap_tool_index.sqlite'
+
+# Header fields fetched to list a folder, without downloading the messages.
+HEADER_FIELDS = 'BODY.PEEK[HEADER.FIELDS (FROM SUBJECT MESSAGE-ID DATE)]'
 
 
 def ensure_directory_exists(path, expand_user=True, file=False):
@@ -51,30 +67,288 @@ def init_dump(path):
     ensure_directory_exists(os.path.join(path, 'new'))
 
 
-def process_email(email_string):
-    """ Extract details from email.
+def load_state(path):
+    """ Load the incremental dump state of a Maildir, {folder: {...}}.
     """
-    message = parse.email.message_from_string(email_string)
     try:
-        from_name = parse.get_mail_addresses(message, 'from')[0][0]
-    except IndexError:
-        from_name = 'none'
+        with open(os.path.join(path, STATE_FILENAME)) as f:
+            return(json.load(f))
+    except (IOError, ValueError):
+        return({})
+
+
+def save_state(path, state):
+    """ Atomically save the incremental dump state of a Maildir.
+    """
+    filename = os.path.join(path, STATE_FILENAME)
+    with open(filename + '.tmp', 'w') as f:
+        json.dump(state, f, indent=4)
+    os.replace(filename + '.tmp', filename)
+
+
+def new_messages(server, folder_info, folder_state):
+    """ Return the UIDs to download and the updated folder state.
+
+        Only UIDs above the last one synced, unless UIDVALIDITY changed, which
+        requires a full resync.
+    """
+    uidvalidity = folder_info.get(b'UIDVALIDITY')
+    last_uid = folder_state.get('last_uid', 0)
+    if folder_state.get('uidvalidity') != uidvalidity:
+        if folder_state:
+            print('UIDVALIDITY changed, full resync.')
+        last_uid = 0
+
+    if last_uid:
+        # n:* always matches the highest UID, even when it is below n.
+        messages = [uid for uid in server.search(['UID', '{}:*'.format(last_uid + 1)]) if uid > last_uid]
+    else:
+        messages = server.search('ALL')
+
+    folder_state = {
+        'uidvalidity': uidvalidity,
+        'uidnext': folder_info.get(b'UIDNEXT'),
+        'highestmodseq': folder_info.get(b'HIGHESTMODSEQ'),
+        'last_uid': last_uid,
+    }
+    return(sorted(messages), folder_state)
+
+
+def fetch_chunks(server, messages, data, batch_size=500):
+    """ Yield (uid, message_data) for messages, one FETCH command per batch_size UIDs.
 
+        Results stream batch by batch instead of holding the whole folder in memory.
+    """
+    for offset in range(0, len(messages), batch_size):
+        batch = messages[offset:offset + batch_size]
+        response = server.fetch(batch, data)
+        for uid in batch:
+            if uid in response:
+                yield uid, response[uid]
+
+
+def batches_by_size(messages, sizes, batch_size=500, max_bytes=64 * 1024 * 1024):
+    """ Split messages into batches of at most batch_size UIDs and max_bytes.
+
+        A message larger than max_bytes is a batch by itself.
+    """
+    batch, batch_bytes = [], 0
+    for uid in messages:
+        size = sizes.get(uid, 0)
+        if batch and (len(batch) >= batch_size or batch_bytes + size > max_bytes):
+            yield batch, batch_bytes
+            batch, batch_bytes = [], 0
+        batch.append(uid)
+        batch_bytes += size
+    if batch:
+        yield batch, batch_bytes
+
+
+class ByteBudget(object):
+    """ Cap the number of bytes in flight across threads.
+
+        A request larger than the limit is granted once nothing else is in flight.
+    """
+    def __init__(self, limit):
+        self.limit = limit
+        self.in_flight = 0
+        self.condition = threading.Condition()
+
+    def acquire(self, size):
+        with self.condition:
+            while self.in_flight and self.in_flight + size > self.limit:
+                self.condition.wait()
+            self.in_flight += size
+
+    def release(self, size):
+        with self.condition:
+            self.in_flight -= size
+            self.condition.notify_all()
+
+
+_maildir_lock = threading.Lock()
+_maildir_count = 0
+
+
+def maildir_filename():
+    """ Return a unique Maildir filename, safe across threads and processes.
+    """
+    global _maildir_count
+    with _maildir_lock:
+        _maildir_count += 1
+        count = _maildir_count
+    now = time.time()
+    hostname = socket.gethostname().replace('/', r'\057').replace(':', r'\072')
+    return('{:.0f}.M{}P{}Q{}T{}.{}'.format(now, int(now % 1 * 1e6), os.getpid(), count, threading.get_ident(), hostname))
+
+
+def maildir_deliver(path, data):
+    """ Deliver a message into the Maildir new/ directory, write to tmp/ then rename.
+
+        Unlike mailbox.Maildir.add() this is safe to call from several threads.
+    """
+    filename = maildir_filename()
+    tmp = os.path.join(path, 'tmp', filename)
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.rename(tmp, os.path.join(path, 'new', filename))
+    return(filename)
+
+
+def dump_worker(connect, folder, work, dst, budget, stats):
+    """ Download batches from the work queue over a single connection.
+    """
+    server = connect()
     try:
-        from_address = parse.get_mail_addresses(message, 'from')[0][1]
-    except IndexError:
-        from_address = 'none'
+        server.select_folder(folder, readonly=True)
+        start = time.time()
+        while True:
+            try:
+                batch, batch_bytes = work.get_nowait()
+            except queue.Empty:
+                break
+
+            budget.acquire(batch_bytes)
+            try:
+                response = server.fetch(batch, 'BODY.PEEK[]')
+                for uid in batch:
+                    if uid in response:
+                        data = response[uid][b'BODY[]']
+                        maildir_deliver(dst, data)
+                        stats['messages'] += 1
+                        stats['bytes'] += len(data)
+                del response
+            finally:
+                budget.release(batch_bytes)
+        stats['seconds'] = time.time() - start
+    finally:
+        server.logout()
+
+
+def parallel_dump(connect, folder, messages, sizes, dst, connections=4, batch_size=500, max_bytes=64 * 1024 * 1024):
+    """ Dump messages from folder into the Maildir dst over several connections.
+
+        connect() returns a new logged in IMAPClient. UIDs are split into batches
+        bounded by count and RFC822.SIZE, connections pull batches from a shared
+        queue and at most max_bytes of message data is in flight at once.
+
+        Return a list of per connection stats, {'messages', 'bytes', 'seconds'}.
+    """
+    init_dump(dst)
+    work = queue.Queue()
+    for batch in batches_by_size(messages, sizes, batch_size, max_bytes // max(connections, 1)):
+        work.put(batch)
+
+    budget = ByteBudget(max_bytes)
+    stats = [{'messages': 0, 'bytes': 0, 'seconds': 0.0} for i in range(connections)]
+    errors = []
+
+    def run(i):
+        try:
+            dump_worker(connect, folder, work, dst, budget, stats[i])
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(connections)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
 
-    header_parser = email.parser.HeaderParser()
-    msg = header_parser.parsestr(email_string)
-    headers = dict(msg.items())
+    if errors:
+        raise errors[0]
+
+    return(stats)
+
+
+def print_stats(stats):
+    """ Print per connection throughput.
+    """
+    for i, rec in enumerate(stats):
+        mb = rec['bytes'] / 1024.0 / 1024.0
+        rate = mb / rec['seconds'] if rec['seconds'] else 0.0
+        print('Connection {}: {} messages, {:.1f} MB, {:.1f} s, {:.2f} MB/s'.format(i, rec['messages'], mb, rec['seconds'], rate))
+
+
+def uid_ranges(messages):
+    """ Return a compact IMAP message set for UIDs, e.g. [1, 2, 3, 5] -> '1:3,5'.
+    """
+    ranges = []
+    start = end = None
+    for uid in sorted(set(messages)):
+        if end is not None and uid == end + 1:
+            end = uid
+            continue
+        if start is not None:
+            ranges.append('{}:{}'.format(start, end) if start != end else str(start))
+        start = end = uid
+    if start is not None:
+        ranges.append('{}:{}'.format(start, end) if start != end else str(start))
+    return(','.join(ranges))
+
+
+def search_criteria(since=None, before=None, from_=None, subject=None, larger=None, smaller=None, flags=None):
+    """ Build IMAP SEARCH criteria, evaluated by the server, ['ALL'] when empty.
+
+        since and before are 'YYYY-MM-DD' dates, larger and smaller are in bytes
+        and flags are search keys like 'UNSEEN' or 'FLAGGED'.
+    """
+    criteria = []
+    if since:
+        criteria += ['SINCE', datetime.datetime.strptime(since, '%Y-%m-%d').date()]
+    if before:
+        criteria += ['BEFORE', datetime.datetime.strptime(before, '%Y-%m-%d').date()]
+    if from_:
+        criteria += ['FROM', from_]
+    if subject:
+        criteria += ['SUBJECT', subject]
+    if larger:
+        criteria += ['LARGER', larger]
+    if smaller:
+        criteria += ['SMALLER', smaller]
+    for flag in flags or []:
+        criteria.append(flag.upper())
+
+    return(criteria or ['ALL'])
+
+
+def transfer_chunks(server, method, messages, folder, chunk_size=5000):
+    """ COPY or MOVE messages to folder, chunk_size UIDs per command.
+
+        Each command sends the UIDs as compact ranges, and progress is printed
+        after every chunk.
+    """
+    messages = sorted(messages)
+    action = getattr(server, method)
+    for offset in range(0, len(messages), chunk_size):
+        batch = messages[offset:offset + chunk_size]
+        action(uid_ranges(batch), folder)
+        print('{}: {}/{}'.format(method, offset + len(batch), len(messages)))
+
+
+def header_data(message_data):
+    """ Return the header fields from a HEADER_FIELDS fetch response.
+    """
+    for key, value in message_data.items():
+        if key.startswith(b'BODY[HEADER'):
+            return(value)
+    return(b'')
+
+
+def process_email(email_string):
+    """ Extract details from email.
+
+        Only the header block is parsed, see email_metadata().
+    """
+    metadata = email_metadata(email_string)
+    try:
+        from_name, from_address = metadata['from'][0]
+    except IndexError:
+        from_name, from_address = 'none', 'none'
 
     from_ = '{} <{}>'.format(from_name, from_address)
-    subject = message['Subject']
-    subject = decode_header(subject)[0][0]
-    message_id = headers.get('Message-ID', '<missing>')
 
-    return({'from': from_, 'subject': subject, 'message_id': message_id})
+    return({'from': from_, 'subject': metadata['subject'], 'message_id': metadata['message_id']})
 
 
 def main():
@@ -128,6 +402,101 @@ def main():
                       default='',
                       help='IMAP password')
 
+    parser.add_option('-i',
+                      '--incremental',
+                      dest='incremental',
+                      action='store_true',
+                      default=False,
+                      help='dump only messages new since the last dump')
+
+    parser.add_option('-b',
+                      '--batch-size',
+                      dest='batch_size',
+                      action='store',
+                      type='int',
+                      default=500,
+                      help='messages per FETCH command [500]')
+
+    parser.add_option('-n',
+                      '--connections',
+                      dest='connections',
+                      action='store',
+                      type='int',
+                      default=1,
+                      help='parallel connections for dump [1]')
+
+    parser.add_option('',
+                      '--max-bytes',
+                      dest='max_bytes',
+                      action='store',
+                      type='int',
+                      default=64,
+                      help='MB of message data in flight for a parallel dump [64]')
+
+    parser.add_option('',
+                      '--since',
+                      dest='since',
+                      action='store',
+                      type='string',
+                      default='',
+                      help='only messages since date, YYYY-MM-DD')
+
+    parser.add_option('',
+                      '--before',
+                      dest='before',
+                      action='store',
+                      type='string',
+                      default='',
+                      help='only messages before date, YYYY-MM-DD')
+
+    parser.add_option('',
+                      '--from',
+                      dest='from_',
+                      action='store',
+                      type='string',
+                      default='',
+                      help='only messages from address')
+
+    parser.add_option('',
+                      '--subject',
+                      dest='subject',
+                      action='store',
+                      type='string',
+                      default='',
+                      help='only messages with subject')
+
+    parser.add_option('',
+                      '--larger',
+                      dest='larger',
+                      action='store',
+                      type='int',
+                      default=0,
+                      help='only messages larger than bytes')
+
+    parser.add_option('',
+                      '--smaller',
+                      dest='smaller',
+                      action='store',
+                      type='int',
+                      default=0,
+                      help='only messages smaller than bytes')
+
+    parser.add_option('',
+                      '--flag',
+                      dest='flags',
+                      action='append',
+                      type='string',
+                      default=[],
+                      help='only messages matching flag, e.g. UNSEEN, FLAGGED (repeatable)')
+
+    parser.add_option('',
+                      '--chunk-size',
+                      dest='chunk_size',
+                      action='store',
+                      type='int',
+                      default=5000,
+                      help='messages per COPY/MOVE command [5000]')
+
     options, args = parser.parse_args()
 
     host = options.host
@@ -136,8 +505,12 @@ def main():
     command = options.command
     src = options.source
     dst = options.destination
+    batch_size = options.batch_size
+    connections = options.connections
+    criteria = search_criteria(options.since, options.before, options.from_, options.subject,
+                               options.larger, options.smaller, options.flags)
 
-    valid_commands = ['ls', 'cp', 'mv', 'mkdir', 'rmdir', 'dump']
+    valid_commands = ['ls', 'cp', 'mv', 'mkdir', 'rmdir', 'dump', 'index', 'search']
 
     if command not in valid_commands:
         print('Unknown command: {}.'.format(command))
@@ -158,6 +531,31 @@ def main():
         parser.print_help()
         sys.exit()
 
+    if command in ['index', 'search'] and not dst:
+        print('Command: {} requires a destination (dump) folder.'.format(command))
+        print('')
+        parser.print_help()
+        sys.exit()
+
+    if command in ['index']:
+        with MaildirIndex(os.path.join(dst, INDEX_FILENAME)) as index:
+            print(index.update(dst))
+        return
+
+    if command in ['search']:
+        with MaildirIndex(os.path.join(dst, INDEX_FILENAME)) as index:
+            try:
+                results = index.search(' '.join(args))
+            except sqlite3.OperationalError as e:
+                print('Invalid search query: {}.'.format(e))
+                print('Queries use the SQLite FTS5 syntax, e.g. invoice AND subject:overdue, quote phrases.')
+                print('')
+                parser.print_help()
+                sys.exit()
+            for result in results:
+                print(result)
+        return
+
     with imapclient.IMAPClient(host) as server:
         server.login(username, password)
         server.select_folder('INBOX', readonly=True)
@@ -177,15 +575,15 @@ def main():
                     print('Unknown folder: {}'.format(src))
                     sys.exit()
 
-                for uid, message_data in server.fetch(messages, 'RFC822').items():
-                    message_string = message_data[b'RFC822']
-
-                    print(process_email(message_string))
+                for uid, message_data in fetch_chunks(server, messages, [HEADER_FIELDS, 'RFC822.SIZE'], batch_size):
+                    details = process_email(header_data(message_data))
+                    details['size'] = message_data.get(b'RFC822.SIZE')
+                    print(details)
 
         if command in ['cp']:
             if src in folders:
                 server.select_folder(src)
-                messages = server.search('ALL')
+                messages = server.search(criteria)
             else:
                 print('Unknown folder: {}'.format(src))
                 sys.exit()
@@ -194,13 +592,13 @@ def main():
                 print('Unknown folder: {}'.format(dst))
                 sys.exit()
 
-            response = server.copy(messages, dst)
+            transfer_chunks(server, 'copy', messages, dst, options.chunk_size)
             server.close_folder()
 
         if command in ['mv']:
             if src in folders:
                 server.select_folder(src)
-                messages = server.search('ALL')
+                messages = server.search(criteria)
             else:
                 print('Unknown folder: {}'.format(src))
                 sys.exit()
@@ -209,7 +607,7 @@ def main():
                 print('Unknown folder: {}'.format(dst))
                 sys.exit()
 
-            response = server.move(messages, dst)
+            transfer_chunks(server, 'move', messages, dst, options.chunk_size)
             server.close_folder()
 
         if command in ['mkdir']:
@@ -237,28 +635,68 @@ def main():
 
         if command in ['dump']:
             if src in folders:
-                server.select_folder(src)
-                messages = server.search('ALL')
+                folder_info = server.select_folder(src)
             else:
                 print('Unknown folder: {}'.format(src))
                 sys.exit()
 
             maildir = mailbox.Maildir(dst)
             init_dump(dst)
-            try:
-                for uid, message_data in server.fetch(messages, 'RFC822').items():
-                    message_string = message_data[b'RFC822']
-                    try:
-                        maildir.add(message_string)
-                    except:
-                        raise
-                        email_message = email.message_from_string(message_string)
-                        error = 'ERROR: From: {}, Subject: {}.'.format(email_message.get('From'), email_message.get('Subject'))
-                        print(error)
-            finally:
-                maildir.flush()
+
+            state = load_state(dst)
+            if options.incremental:
+                messages, folder_state = new_messages(server, folder_info, state.get(src, {}))
+                print('New messages: {}'.format(len(messages)))
+            else:
+                messages = server.search('ALL')
+                folder_state = None
+
+            if connections > 1:
                 maildir.close()
 
+                def connect():
+                    client = imapclient.IMAPClient(host)
+                    client.login(username, password)
+                    return(client)
+
+                sizes = {}
+                for uid, message_data in fetch_chunks(server, messages, 'RFC822.SIZE', 5000):
+                    sizes[uid] = message_data[b'RFC822.SIZE']
+
+                stats = parallel_dump(connect, src, messages, sizes, dst, connections, batch_size, options.max_bytes * 1024 * 1024)
+                print_stats(stats)
+
+                if folder_state is not None:
+                    folder_state['last_uid'] = max(messages + [folder_state['last_uid']])
+                    state[src] = folder_state
+                    save_state(dst, state)
+
+            else:
+                try:
+                    for count, (uid, message_data) in enumerate(fetch_chunks(server, messages, 'RFC822', batch_size), 1):
+                        message_string = message_data[b'RFC822']
+                        try:
+                            maildir.add(message_string)
+                        except:
+                            raise
+                            email_message = email.message_from_string(message_string)
+                            error = 'ERROR: From: {}, Subject: {}.'.format(email_message.get('From'), email_message.get('Subject'))
+                            print(error)
+
+                        if folder_state is not None:
+                            folder_state['last_uid'] = max(folder_state['last_uid'], uid)
+                            # Checkpoint every batch, an interrupted dump resumes from here.
+                            if count % batch_size == 0:
+                                state[src] = folder_state
+                                save_state(dst, state)
+
+                    if folder_state is not None:
+                        state[src] = folder_state
+                        save_state(dst, state)
+                finally:
+                    maildir.flush()
+                    maildir.close()
+
             server.close_folder()
 
 
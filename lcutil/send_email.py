@@ -28,6 +28,7 @@ import smtplib
 import sys
 
 from lcutil.netrc import Netrc
+from lcutil.util_email import MailQueue, SMTPSender, text_message
 
 
 def text_email(from_='',
@@ -119,6 +120,29 @@ def main():
                       default='',
                       help='to addresses')
 
+    parser.add_option('-q',
+                      '--queue',
+                      dest='queue',
+                      action='store',
+                      type='string',
+                      default='',
+                      help='enqueue into this mail queue (sqlite) instead of sending')
+
+    parser.add_option('',
+                      '--drain',
+                      dest='drain',
+                      action='store_true',
+                      default=False,
+                      help='send the messages in the mail queue')
+
+    parser.add_option('-n',
+                      '--connections',
+                      dest='connections',
+                      action='store',
+                      type='int',
+                      default=2,
+                      help='SMTP connections used to drain the queue [2]')
+
     options, args = parser.parse_args()
 
     label = options.label
@@ -127,6 +151,23 @@ def main():
     subject = options.subject
     body = options.body
 
+    if options.drain:
+        if not options.queue:
+            print('Option --drain requires --queue.')
+            sys.exit()
+
+        with MailQueue(options.queue) as queue:
+            with SMTPSender(netrc.host, netrc.port, netrc.username, netrc.password, connections=options.connections) as sender:
+                sent = queue.drain(sender)
+            print('Sent: {}, queue: {}'.format(sent, queue.stats()))
+        return
+
+    if options.queue:
+        message = text_message(from_=netrc['from'], to=to, subject=subject, body=body, files=args)
+        with MailQueue(options.queue) as queue:
+            queue.enqueue(netrc['from'], to, message)
+        return
+
     text_email(
         from_=netrc['from'],  # reserved word
         to=to,
@@ -3,6 +3,39 @@
     Should work with DB API 2.0 cursors, tested with psycopg2.
     https://www.python.org/dev/peps/pep-0249/
 """
+import array
+import collections
+import concurrent.futures
+import contextlib
+import functools
+import hashlib
+import io
+import itertools
+import os
+import pickle
+import queue
+import shelve
+import threading
+import time
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+# Positional parameter markers for the DB API 2.0 paramstyles we support.
+MARKERS = {
+    'format': '%s',
+    'pyformat': '%s',
+    'qmark': '?',
+}
+
+# Driver paramstyle per SQL dialect.
+PARAMSTYLES = {
+    'postgresql': 'format',
+    'sqlite': 'qmark',
+}
 
 
 def as_dicts(cursor):
@@ -17,21 +50,189 @@ def as_dicts(cursor):
     return(result)
 
 
-def dict_iter(cursor):
+@functools.lru_cache(maxsize=128)
+def record_type(fields):
+    """ Return a compact tuple based record class for a tuple of field names.
+
+        Records support dict-like (record['name'], keys(), items(), get()) and
+        attribute (record.name) access without allocating a dict per row.
+        Classes are cached on the field names, so a result-set only builds one.
+
+        A record is still a tuple: iteration, len(), `in` and == work on the
+        values, not the field names, and record[0] is the first value. Fields
+        named like a method (count, index, keys, values, items, get) are
+        shadowed as attributes, use record['count'] for those.
+    """
+    index = {field: idx for idx, field in enumerate(fields)}
+
+    class Record(tuple):
+        __slots__ = ()
+
+        _fields = fields
+        _index = index
+
+        def __getitem__(self, key):
+            if isinstance(key, str):
+                key = self._index[key]
+            return tuple.__getitem__(self, key)
+
+        def __getattr__(self, name):
+            try:
+                return tuple.__getitem__(self, self._index[name])
+            except KeyError:
+                raise AttributeError(name)
+
+        def __repr__(self):
+            return 'Record({})'.format(', '.join('{}={!r}'.format(k, v) for k, v in zip(self._fields, self)))
+
+        def keys(self):
+            return self._fields
+
+        def values(self):
+            return tuple(self)
+
+        def items(self):
+            return zip(self._fields, self)
+
+        def get(self, key, default=None):
+            try:
+                return self[key]
+            except (KeyError, IndexError):
+                return default
+
+        def _asdict(self):
+            return dict(zip(self._fields, self))
+
+    return Record
+
+
+def iter_batches(cursor, size=1000):
+    """ A generator of row batches fetched with cursor.fetchmany(size).
+
+        One round trip per batch instead of one per row (fetchone).
+    """
+    while True:
+        rows = cursor.fetchmany(size)
+        if not rows:
+            break
+        yield rows
+
+
+def dict_iter(cursor, size=1000, records=False):
     """ A generator of result-set dictionaries.
 
         Use this function when the result-set don't fit into memory.
+
+        Rows are fetched in batches of `size` with cursor.fetchmany(). With
+        records=True rows are yielded as record_type() instances instead of
+        dicts, which avoids the per-row dict allocation.
+
+        psycopg2 named (server-side) cursors only fill cursor.description after
+        the first fetch, so the fields are resolved after the first batch.
     """
-    fields = [k[0] for k in cursor.description]
-    row = cursor.fetchone()
-    while row:
-        yield dict(zip(fields, row))
-        row = cursor.fetchone()
+    fields = None
+    for rows in iter_batches(cursor, size):
+        if fields is None:
+            fields = tuple(k[0] for k in cursor.description)
+            record = record_type(fields) if records else None
+
+        if records:
+            for row in rows:
+                yield record(row)
+        else:
+            for row in rows:
+                yield dict(zip(fields, row))
+
+
+# array.array typecodes for psycopg2 type OIDs (cursor.description type_code).
+TYPECODES = {
+    16: '?',  # bool, stored as 'b'
+    20: 'q',  # int8
+    21: 'h',  # int2
+    23: 'l',  # int4
+    700: 'f',  # float4
+    701: 'd',  # float8
+}
+
+
+def column_typecode(type_code, value):
+    """ Return the array.array typecode for a column, None if it is not numeric.
+
+        Use the driver type code when known, otherwise (e.g. sqlite3) infer it from
+        the first value. Booleans are '?' (the NumPy and struct code), which
+        array.array lacks, they are stored as 'b'.
+    """
+    if type_code in TYPECODES:
+        return(TYPECODES[type_code])
+    if isinstance(value, bool):
+        return('?')
+    if isinstance(value, int):
+        return('q')
+    if isinstance(value, float):
+        return('d')
+    return(None)
+
+
+def as_columns(cursor, size=1000, as_numpy=True):
+    """ Return a dictionary of columns {field: column} from a result-set.
+
+        Numeric columns are compact array.array's (NumPy arrays when NumPy is
+        installed and as_numpy=True), other columns are lists. Columns are filled
+        from fetchmany(size) batches, no per-row dictionaries are created.
+        A numeric column that contains NULLs or out of range values falls back to
+        a list. Boolean columns are NumPy bool arrays, or lists of bools.
+    """
+    columns = None
+    for rows in iter_batches(cursor, size):
+        if columns is None:
+            description = cursor.description
+            columns = []
+            booleans = []
+            for idx, column in enumerate(description):
+                typecode = column_typecode(column[1], rows[0][idx])
+                if typecode == '?':
+                    booleans.append(idx)
+                    typecode = 'b'
+                columns.append(array.array(typecode) if typecode else [])
+
+        for idx, values in enumerate(zip(*rows)):
+            column = columns[idx]
+            if isinstance(column, array.array):
+                try:
+                    column.extend(array.array(column.typecode, values))
+                except (TypeError, OverflowError):
+                    columns[idx] = column.tolist() + list(values)
+            else:
+                column.extend(values)
+
+    if columns is None:
+        return({k[0]: [] for k in cursor.description or []})
+
+    if numpy is not None and as_numpy:
+        dtypes = [bool if idx in booleans else getattr(column, 'typecode', None) for idx, column in enumerate(columns)]
+        columns = [numpy.frombuffer(column, dtype=dtype) if isinstance(column, array.array) else column for column, dtype in zip(columns, dtypes)]
+    else:
+        columns = [[bool(value) for value in column] if idx in booleans and isinstance(column, array.array) else column for idx, column in enumerate(columns)]
+
+    return(dict(zip([k[0] for k in description], columns)))
 
 
-def insert_record(cursor, table, record):
+def server_cursor(connection, name='lcutil_cursor', size=1000):
+    """ Return a psycopg2 named (server-side) cursor.
+
+        The result-set stays on the server and is streamed with FETCH FORWARD,
+        use it with dict_iter(cursor, size=size).
+    """
+    cursor = connection.cursor(name=name)
+    cursor.itersize = size
+    cursor.arraysize = size
+    return(cursor)
+
+
+def insert_record(cursor, table, record, cache=None):
     """ Insert a given record into the table specified.
 
+        Cached results tagged with the table are evicted from cache (a QueryCache).
         cursor.commit() should be preformed outside this function.
     """
     fields = ', '.join(record.keys())
@@ -39,3 +240,709 @@ def insert_record(cursor, table, record):
     sql = "INSERT into %s (%s) VALUES (%s);" % (table, fields, values)
 
     cursor.execute(sql, record)
+
+    if cache is not None:
+        cache.invalidate(table)
+
+
+@functools.lru_cache(maxsize=256)
+def insert_sql(table, fields, rows=1, paramstyle='format'):
+    """ Return (cached) multi-row INSERT statement text for a table and column set.
+    """
+    marker = MARKERS[paramstyle]
+    values = '(%s)' % ', '.join([marker] * len(fields))
+    sql = "INSERT into %s (%s) VALUES %s;" % (table, ', '.join(fields), ', '.join([values] * rows))
+    return(sql)
+
+
+def copy_escape(value):
+    """ Escape a value for the PostgreSQL COPY text format.
+    """
+    if value is None:
+        return('\\N')
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        # bytea hex format, its backslash escaped for COPY.
+        return('\\\\x' + bytes(value).hex())
+    value = str(value)
+    return(value.replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r'))
+
+
+def insert_batch(cursor, table, fields, rows, paramstyle='format', copy=False):
+    """ Insert a batch of value tuples with a single statement.
+
+        With copy=True and a cursor supporting copy_expert (psycopg2) the batch
+        is sent with COPY FROM STDIN instead of a multi-row INSERT.
+    """
+    if copy and hasattr(cursor, 'copy_expert'):
+        buffer = io.StringIO()
+        for row in rows:
+            buffer.write('\t'.join([copy_escape(value) for value in row]))
+            buffer.write('\n')
+        buffer.seek(0)
+        cursor.copy_expert('COPY %s (%s) FROM STDIN' % (table, ', '.join(fields)), buffer)
+    else:
+        params = [value for row in rows for value in row]
+        cursor.execute(insert_sql(table, fields, len(rows), paramstyle), params)
+
+
+def insert_records(cursor, table, records, batch_size=1000, paramstyle='format', copy=False, cache=None):
+    """ Insert records (dictionaries) into the table specified in multi-row batches.
+
+        Records are streamed from any iterable, e.g. dict_iter(), and grouped by
+        their column set; each group is sent as soon as it holds batch_size rows.
+        The statement text is cached per (table, columns, rows).
+
+        paramstyle is the positional style of the driver: 'format' (psycopg2,
+        MySQLdb) or 'qmark' (sqlite3). Keep batch_size * columns below the
+        driver's bind parameter limit (32766 for sqlite3 >= 3.32).
+
+        Returns the number of records inserted.
+        Cached results tagged with the table are evicted from cache (a QueryCache).
+        cursor.commit() should be preformed outside this function.
+    """
+    pending = {}
+    count = 0
+    for record in records:
+        fields = tuple(record.keys())
+        rows = pending.setdefault(fields, [])
+        rows.append(tuple(record.values()))
+        if len(rows) >= batch_size:
+            insert_batch(cursor, table, fields, rows, paramstyle, copy)
+            count += len(rows)
+            del pending[fields]
+
+    for fields, rows in pending.items():
+        insert_batch(cursor, table, fields, rows, paramstyle, copy)
+        count += len(rows)
+
+    if cache is not None:
+        cache.invalidate(table)
+
+    return(count)
+
+
+@functools.lru_cache(maxsize=256)
+def upsert_sql(table, fields, key, rows=1, dialect='postgresql'):
+    """ Return (cached) multi-row upsert statement text.
+
+        PostgreSQL: INSERT ... ON CONFLICT (key) DO UPDATE ... RETURNING (xmax = 0),
+        the returned flag is true for inserted rows.
+        SQLite: INSERT OR REPLACE, the conflicting row is deleted and re-inserted.
+    """
+    marker = MARKERS[PARAMSTYLES[dialect]]
+    values = '(%s)' % ', '.join([marker] * len(fields))
+    values = ', '.join([values] * rows)
+
+    if dialect == 'sqlite':
+        return("INSERT OR REPLACE into %s (%s) VALUES %s;" % (table, ', '.join(fields), values))
+
+    updates = ', '.join(['%s = EXCLUDED.%s' % (field, field) for field in fields if field not in key])
+    action = 'DO UPDATE SET %s' % updates if updates else 'DO NOTHING'
+    sql = "INSERT into %s (%s) VALUES %s ON CONFLICT (%s) %s RETURNING (xmax = 0);" % (table, ', '.join(fields), values, ', '.join(key), action)
+    return(sql)
+
+
+@functools.lru_cache(maxsize=256)
+def existing_sql(table, key, rows=1, dialect='sqlite'):
+    """ Return (cached) statement text counting the keys already present in a table.
+    """
+    marker = MARKERS[PARAMSTYLES[dialect]]
+    values = '(%s)' % ', '.join([marker] * len(key))
+    sql = "SELECT COUNT(*) FROM %s WHERE (%s) IN (VALUES %s);" % (table, ', '.join(key), ', '.join([values] * rows))
+    return(sql)
+
+
+def upsert_batch(cursor, table, fields, key, rows, dialect='postgresql'):
+    """ Upsert a batch of value tuples with a single statement.
+
+        Returns (inserted, updated, unchanged). When every field is part of
+        the key there is nothing to update (DO NOTHING, RETURNING skips those
+        rows), existing rows are counted as unchanged.
+    """
+    params = [value for row in rows for value in row]
+    key_only = set(fields) <= set(key)
+    if dialect == 'sqlite':
+        positions = [fields.index(field) for field in key]
+        cursor.execute(existing_sql(table, key, len(rows), dialect), [row[idx] for row in rows for idx in positions])
+        existing = cursor.fetchone()[0]
+        cursor.execute(upsert_sql(table, fields, key, len(rows), dialect), params)
+    else:
+        cursor.execute(upsert_sql(table, fields, key, len(rows), dialect), params)
+        existing = len(rows) - sum(1 for (flag,) in cursor.fetchall() if flag)
+
+    if key_only:
+        return(len(rows) - existing, 0, existing)
+    return(len(rows) - existing, existing, 0)
+
+
+def upsert_records(cursor, table, records, key, batch_size=1000, dialect='postgresql', cache=None):
+    """ Insert or update records (dictionaries) in multi-row batches.
+
+        key is the list of conflict target columns (a primary key or unique
+        constraint), every record must contain them. Records are grouped by column
+        set like insert_records(), within a batch the last record for a key wins.
+        dialect is 'postgresql' (ON CONFLICT DO UPDATE) or 'sqlite' (INSERT OR
+        REPLACE, which resets columns missing from the record).
+
+        Returns {'inserted': n, 'updated': n, 'unchanged': n}, unchanged counts
+        existing rows when every column is part of the key.
+        Cached results tagged with the table are evicted from cache (a QueryCache).
+        cursor.commit() should be preformed outside this function.
+    """
+    key = tuple(key)
+    counts = {'inserted': 0, 'updated': 0, 'unchanged': 0}
+
+    def flush(fields, rows):
+        inserted, updated, unchanged = upsert_batch(cursor, table, fields, key, list(rows.values()), dialect)
+        counts['inserted'] += inserted
+        counts['updated'] += updated
+        counts['unchanged'] += unchanged
+
+    pending = {}
+    for record in records:
+        fields = tuple(record.keys())
+        rows = pending.setdefault(fields, {})
+        rows[tuple(record[field] for field in key)] = tuple(record.values())
+        if len(rows) >= batch_size:
+            flush(fields, rows)
+            del pending[fields]
+
+    for fields, rows in pending.items():
+        flush(fields, rows)
+
+    if cache is not None:
+        cache.invalidate(table)
+
+    return(counts)
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class PooledConnection(object):
+    """ A pooled connection and its bookkeeping.
+    """
+    def __init__(self, connection):
+        self.connection = connection
+        self.created = time.monotonic()
+        self.last_used = self.created
+        self.statements = 0
+
+
+class CountingCursor(object):
+    """ Cursor proxy that counts the statements executed on a pooled connection.
+    """
+    def __init__(self, cursor, pooled):
+        self._cursor = cursor
+        self._pooled = pooled
+
+    def execute(self, *args, **kwargs):
+        self._pooled.statements += 1
+        return self._cursor.execute(*args, **kwargs)
+
+    def executemany(self, *args, **kwargs):
+        self._pooled.statements += 1
+        return self._cursor.executemany(*args, **kwargs)
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+class ConnectionPool(object):
+    """ Thread-safe pool of DB API 2.0 connections.
+
+        connect is a callable returning a new connection, e.g.
+        functools.partial(psycopg2.connect, dsn) or
+        functools.partial(sqlite3.connect, path, check_same_thread=False).
+
+        pool = ConnectionPool(connect, min_size=2, max_size=10)
+        with pool.cursor() as cursor:
+            cursor.execute(sql, params)
+            rows = as_dicts(cursor)
+
+        Idle connections above min_size are closed after idle_timeout seconds,
+        connections are recycled after max_statements statements and checked with
+        health_check (SQL, None to disable) on checkout. Checkout blocks up to
+        timeout seconds for a free connection before raising PoolTimeout.
+    """
+    def __init__(self, connect, min_size=1, max_size=10, idle_timeout=300, timeout=30, health_check='SELECT 1', max_statements=None):
+        self.connect = connect
+        self.min_size = min_size
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self.health_check = health_check
+        self.max_statements = max_statements
+
+        self.metrics = {
+            'created': 0,
+            'closed': 0,
+            'checkouts': 0,
+            'failed_checks': 0,
+            'timeouts': 0,
+            'wait_time': 0.0,
+            'max_wait_time': 0.0,
+        }
+
+        self._condition = threading.Condition()
+        self._idle = collections.deque()
+        self._in_use = set()
+        self._size = 0
+
+        for _ in range(min_size):
+            self._size += 1
+            self._idle.append(self._create())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _create(self):
+        """ Open a new connection, the caller reserved a slot in self._size.
+        """
+        try:
+            pooled = PooledConnection(self.connect())
+        except Exception:
+            with self._condition:
+                self._size -= 1
+                self._condition.notify()
+            raise
+
+        with self._condition:
+            self.metrics['created'] += 1
+
+        return(pooled)
+
+    def _discard(self, pooled):
+        """ Close a connection and release its slot.
+        """
+        try:
+            pooled.connection.close()
+        except Exception:
+            pass
+
+        with self._condition:
+            self._size -= 1
+            self.metrics['closed'] += 1
+            self._condition.notify()
+
+    def _expired(self):
+        """ Remove idle connections above min_size that exceeded idle_timeout.
+
+            Must be called with the lock held, the caller closes them.
+        """
+        expired = []
+        now = time.monotonic()
+        # Least recently used connections are on the left.
+        while self._idle and self._size - len(expired) > self.min_size and now - self._idle[0].last_used > self.idle_timeout:
+            expired.append(self._idle.popleft())
+        return(expired)
+
+    def _healthy(self, pooled):
+        """ Run the health check statement on a connection.
+        """
+        if not self.health_check:
+            return(True)
+
+        try:
+            cursor = pooled.connection.cursor()
+            try:
+                cursor.execute(self.health_check)
+                cursor.fetchall()
+            finally:
+                cursor.close()
+            # psycopg2 opens a transaction for the probe, hand the connection out idle.
+            pooled.connection.rollback()
+        except Exception:
+            return(False)
+
+        return(True)
+
+    def checkout(self):
+        """ Return a PooledConnection, wait for one if the pool is exhausted.
+        """
+        start = time.monotonic()
+        deadline = start + self.timeout
+
+        while True:
+            pooled = None
+            with self._condition:
+                while True:
+                    expired = self._expired()
+                    if self._idle:
+                        pooled = self._idle.pop()
+                        break
+                    if self._size < self.max_size:
+                        self._size += 1
+                        break
+
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self.metrics['timeouts'] += 1
+                        raise PoolTimeout('No connection available after {} seconds.'.format(self.timeout))
+                    self._condition.wait(remaining)
+
+            for item in expired:
+                self._discard(item)
+
+            if pooled is None:
+                pooled = self._create()
+            elif not self._healthy(pooled):
+                with self._condition:
+                    self.metrics['failed_checks'] += 1
+                self._discard(pooled)
+                continue
+
+            break
+
+        wait_time = time.monotonic() - start
+        with self._condition:
+            self._in_use.add(pooled)
+            self.metrics['checkouts'] += 1
+            self.metrics['wait_time'] += wait_time
+            self.metrics['max_wait_time'] = max(self.metrics['max_wait_time'], wait_time)
+
+        return(pooled)
+
+    def checkin(self, pooled, discard=False):
+        """ Return a connection to the pool, uncommitted work is rolled back.
+        """
+        with self._condition:
+            self._in_use.discard(pooled)
+
+        if not discard:
+            # The next checkout must not inherit an open transaction.
+            try:
+                pooled.connection.rollback()
+            except Exception:
+                discard = True
+
+        if discard or (self.max_statements and pooled.statements >= self.max_statements):
+            self._discard(pooled)
+            return
+
+        pooled.last_used = time.monotonic()
+        with self._condition:
+            self._idle.append(pooled)
+            self._condition.notify()
+
+    @contextlib.contextmanager
+    def connection(self):
+        """ Context manager checking out a connection, commit explicitly.
+
+            Uncommitted work is rolled back when the connection is returned.
+        """
+        pooled = self.checkout()
+        try:
+            yield pooled.connection
+        finally:
+            self.checkin(pooled)
+
+    @contextlib.contextmanager
+    def cursor(self):
+        """ Context manager yielding a cursor, commit on success, rollback on errors.
+        """
+        pooled = self.checkout()
+        discard = False
+        try:
+            cursor = CountingCursor(pooled.connection.cursor(), pooled)
+            try:
+                yield cursor
+                pooled.connection.commit()
+            finally:
+                cursor.close()
+        except Exception:
+            try:
+                pooled.connection.rollback()
+            except Exception:
+                discard = True
+            raise
+        finally:
+            self.checkin(pooled, discard=discard)
+
+    def stats(self):
+        """ Return pool size, checkout/wait-time metrics and per-connection statement counts.
+        """
+        with self._condition:
+            stats = dict(self.metrics)
+            stats['size'] = self._size
+            stats['idle'] = len(self._idle)
+            stats['in_use'] = len(self._in_use)
+            stats['average_wait_time'] = self.metrics['wait_time'] / (self.metrics['checkouts'] or 1)
+            stats['statements'] = [pooled.statements for pooled in list(self._idle) + list(self._in_use)]
+
+        return(stats)
+
+    def close(self):
+        """ Close all idle connections.
+        """
+        with self._condition:
+            idle = list(self._idle)
+            self._idle.clear()
+
+        for pooled in idle:
+            self._discard(pooled)
+
+
+class ConnectionWorkers(object):
+    """ Worker threads that each own a database connection.
+
+        A connection is opened, used and closed by the same thread, as
+        drivers like sqlite3 require. submit(function, *args) runs
+        function(connection, *args) and returns a concurrent.futures.Future.
+    """
+    def __init__(self, connect, workers=4):
+        self.connect = connect
+        self.tasks = queue.Queue()
+        self.threads = [threading.Thread(target=self.run, daemon=True) for i in range(workers)]
+        for thread in self.threads:
+            thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
+
+    def run(self):
+        connection = None
+        try:
+            while True:
+                task = self.tasks.get()
+                if task is None:
+                    break
+
+                future, function, args = task
+                if not future.set_running_or_notify_cancel():
+                    continue
+                try:
+                    if connection is None:
+                        connection = self.connect()
+                    future.set_result(function(connection, *args))
+                except BaseException as e:
+                    future.set_exception(e)
+        finally:
+            if connection is not None:
+                connection.close()
+
+    def submit(self, function, *args):
+        future = concurrent.futures.Future()
+        self.tasks.put((future, function, args))
+        return(future)
+
+    def shutdown(self):
+        """ Finish the submitted tasks, close the connections and stop the threads.
+        """
+        for thread in self.threads:
+            self.tasks.put(None)
+        for thread in self.threads:
+            thread.join()
+
+
+def run_many(pool_or_connect, sql, param_sets, workers=4, ordered=True, in_flight=None):
+    """ Execute the same query for each set of parameters in parallel, yield result-set dictionaries.
+
+        pool_or_connect is a ConnectionPool (max_size >= workers) or a connect
+        callable, in which case every worker thread opens its own connection
+        (see ConnectionWorkers). With ordered=True results follow the order
+        of param_sets, otherwise result-sets are yielded as they complete. At
+        most in_flight (default 2 * workers) result-sets are queued or held
+        in memory at a time.
+    """
+    in_flight = in_flight or 2 * workers
+
+    if isinstance(pool_or_connect, ConnectionPool):
+        pool = pool_or_connect
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+
+        def query(params):
+            with pool.cursor() as cursor:
+                cursor.execute(sql, params)
+                return as_dicts(cursor)
+    else:
+        executor = ConnectionWorkers(pool_or_connect, workers)
+
+        def query(connection, params):
+            cursor = connection.cursor()
+            try:
+                cursor.execute(sql, params)
+                return as_dicts(cursor)
+            finally:
+                cursor.close()
+                connection.rollback()
+
+    param_sets = iter(param_sets)
+    pending = collections.deque()
+    with executor:
+        try:
+            for params in itertools.islice(param_sets, in_flight):
+                pending.append(executor.submit(query, params))
+
+            while pending:
+                if ordered:
+                    future = pending.popleft()
+                else:
+                    done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                    future = done.pop()
+                    pending.remove(future)
+
+                rows = future.result()
+                for params in itertools.islice(param_sets, 1):
+                    pending.append(executor.submit(query, params))
+
+                for row in rows:
+                    yield row
+        finally:
+            for future in pending:
+                future.cancel()
+
+
+class QueryCache(object):
+    """ Opt-in TTL/LRU cache for read-only query results.
+
+        cache = QueryCache(ttl=10, max_entries=1000, max_bytes=64 * 2**20)
+        rows = cache.as_dicts(cursor, sql, params, tables=['orders'])
+        insert_record(cursor, 'orders', record, cache=cache)
+
+        Results are keyed on (sql, params) and stored pickled, so callers get a
+        private copy and max_bytes accounts for the real size. tables tag an entry
+        so writes to those tables (invalidate()) evict it. With path set the cache
+        is backed by a shelve file and survives process restarts.
+    """
+    def __init__(self, ttl=60, max_entries=1024, max_bytes=None, path=None):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._lock = threading.RLock()
+        self._entries = collections.OrderedDict()  # key: (expires, size, tags), least recently used first.
+        self._bytes = 0
+
+        if path:
+            self._values = shelve.open(os.path.expanduser(path))
+            now = time.time()
+            for key in list(self._values):
+                expires, tags, data = self._values[key]
+                if expires is not None and expires <= now:
+                    del self._values[key]
+                else:
+                    self._entries[key] = (expires, len(data), tags)
+                    self._bytes += len(data)
+            self._evict()
+        else:
+            self._values = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    @staticmethod
+    def key(sql, params=None):
+        """ Return the cache key of a query.
+        """
+        return(hashlib.sha1(pickle.dumps((sql, params))).hexdigest())
+
+    def _remove(self, key):
+        expires, size, tags = self._entries.pop(key)
+        self._bytes -= size
+        del self._values[key]
+
+    def _evict(self):
+        while self._entries and (len(self._entries) > self.max_entries or (self.max_bytes and self._bytes > self.max_bytes)):
+            self._remove(next(iter(self._entries)))
+            self.evictions += 1
+
+    def get(self, sql, params=None):
+        """ Return the cached result of a query, None on a miss.
+        """
+        key = self.key(sql, params)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] is not None and entry[0] <= time.time():
+                self._remove(key)
+                entry = None
+
+            if entry is None:
+                self.misses += 1
+                return(None)
+
+            self.hits += 1
+            self._entries.move_to_end(key)
+            data = self._values[key][2]
+
+        return(pickle.loads(data))
+
+    def set(self, sql, params, result, tables=()):
+        """ Cache the result of a query, tagged with the tables it reads.
+        """
+        key = self.key(sql, params)
+        data = pickle.dumps(result, protocol=pickle.HIGHEST_PROTOCOL)
+        expires = time.time() + self.ttl if self.ttl is not None else None
+        tags = frozenset(tables)
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (expires, len(data), tags)
+            self._values[key] = (expires, tags, data)
+            self._bytes += len(data)
+            self._evict()
+
+    def as_dicts(self, cursor, sql, params=None, tables=()):
+        """ Return the result-set dictionaries of a query, from the cache when possible.
+        """
+        result = self.get(sql, params)
+        if result is None:
+            if params is None:
+                cursor.execute(sql)
+            else:
+                cursor.execute(sql, params)
+            result = as_dicts(cursor)
+            self.set(sql, params, result, tables)
+
+        return(result)
+
+    def invalidate(self, *tables):
+        """ Evict all entries tagged with any of the tables.
+        """
+        tables = set(tables)
+        with self._lock:
+            for key, (expires, size, tags) in list(self._entries.items()):
+                if tags & tables:
+                    self._remove(key)
+
+    def clear(self):
+        """ Evict all entries.
+        """
+        with self._lock:
+            for key in list(self._entries):
+                self._remove(key)
+
+    def stats(self):
+        """ Return hit/miss/eviction counters and the cache size.
+        """
+        with self._lock:
+            return({
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+            })
+
+    def close(self):
+        """ Flush and close the on-disk backing store.
+        """
+        if isinstance(self._values, shelve.Shelf):
+            self._values.close()
@@ -4,23 +4,47 @@
 
     html_email deals correctly with attachments and inline images as used by MS Exchange and Thunderbird.
 """
+import asyncio
+import base64
+import binascii
+import concurrent.futures
+import contextlib
 import datetime
+import email.policy
+import email.utils
 from email.encoders import encode_base64
-from email.header import decode_header
+from email.errors import HeaderParseError
+from email.header import decode_header, make_header
+from email.message import Message
 from email.mime.image import MIMEImage
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEBase, MIMEMultipart
-from email.parser import HeaderParser
-from email.utils import COMMASPACE, formatdate, make_msgid, parsedate
+from email.parser import BytesHeaderParser
+from email.utils import COMMASPACE, formatdate, getaddresses, make_msgid, parsedate_to_datetime
+import functools
+import hashlib
+import html
+import itertools
 import json
 import logging
 import logging.config
+import mailbox
 import mimetypes
+import mmap
 import os
+import queue
+import re
+import shutil
 import smtplib
+import socket
+import sqlite3
+import ssl
+import string
 import sys
 import tempfile
+import threading
 import time
+import uuid
 
 from text_unidecode import unidecode
 
@@ -31,114 +55,1126 @@ logger.addHandler(logging.NullHandler())
 
 mimetypes.init()
 
-try:
-    from pyzmail import parse
-except ImportError:
-    pass
-else:
-    def strip_header(email_string):
-        """ Remove content-description/type/disposition header.
+# Attachments are read and base64 encoded in chunks of this many bytes when streaming,
+# a multiple of 57 bytes (one 76 character base64 line).
+CHUNK_SIZE = 57 * 1024
+
+# Header blocks are searched for in the first HEADER_LIMIT bytes of a message.
+HEADER_LIMIT = 1024 * 1024
+
+# End of a message header block, the first blank line.
+HEADER_END = re.compile(br'\r?\n\r?\n')
+
+# Folded header line breaks, unfolding removes them (RFC 5322 2.2.3).
+FOLD = re.compile(r'\r?\n(?=[ \t])')
+
+# HTML bodies are indexed as text, scripts, styles and tags removed.
+HTML_SKIP = re.compile(r'(?is)<(script|style)\b.*?</\1\s*>')
+HTML_TAG = re.compile(r'(?s)<[^>]*>')
+
+# What may follow a boundary on its delimiter line, the close marker or whitespace (RFC 2046 5.1.1).
+DELIMITER_END = re.compile(br'--|[ \t]*(?:\r?\n|\r?\Z)')
+
+# The process umask, reading it means setting it, so it is read once. Blobs are
+# written to mkstemp() files (mode 0600) and get the mode open() would give them.
+UMASK = os.umask(0)
+os.umask(UMASK)
+
+# Lines starting with a period are escaped in the SMTP DATA command (RFC 5321 4.5.2).
+DOT_STUFF = re.compile(br'(?m)^\.')
+
+# Bare CR or LF line endings, SMTP requires CRLF (RFC 5321 2.3.8).
+EOL = re.compile(r'\r\n|\r|\n')
+
+
+def header_block(data):
+    """ Return the header block of a message (bytes), up to the first blank line.
+    """
+    match = HEADER_END.search(data)
+    if match is None:
+        return(data)
+    return(data[:match.start() + 1])
+
+
+def header_text(value):
+    """ Return a raw header value as str, 8-bit bytes (RFC 6532) decoded as UTF-8 or latin-1.
+
+        The parsers keep undecodable bytes as surrogate escapes.
+    """
+    try:
+        raw = value.encode('ascii', 'surrogateescape')
+    except UnicodeEncodeError:
+        return(value)
+    try:
+        return(raw.decode('utf-8'))
+    except UnicodeDecodeError:
+        return(raw.decode('latin-1'))
+
+
+def decode_header_value(value):
+    """ Return an (RFC 2047 encoded) header value as str, unfolded.
+    """
+    value = header_text(FOLD.sub('', str(value or '')))
+    try:
+        return(str(make_header(decode_header(value))))
+    except (HeaderParseError, LookupError, UnicodeError):
+        pass
+
+    # Encoded words mixed with raw non-ASCII text, decode_header() returns the latter raw-unicode-escape encoded.
+    try:
+        return(''.join(part.decode(charset or 'raw-unicode-escape', 'replace') if isinstance(part, bytes) else part for part, charset in decode_header(value)))
+    except (HeaderParseError, LookupError):
+        return(value)
+
+
+def email_metadata(data):
+    """ Return from, to, subject, message_id and date of a message (bytes or str).
+
+        Only the header block is parsed, bodies are never decoded. Raw 8-bit
+        header values are read as UTF-8 (RFC 6532), or latin-1 if invalid.
+        Dates are timezone aware, a date without zone (-0000) is taken as UTC.
+    """
+    if isinstance(data, str):
+        data = data.encode('utf-8', 'surrogateescape')
+    headers = BytesHeaderParser().parsebytes(header_block(data))
+
+    # Raw values, surrogate escaped, parsed values of 8-bit headers are email.header.Header instances.
+    raw = {}
+    for name, value in headers.raw_items():
+        raw.setdefault(name.lower(), []).append(FOLD.sub('', value))
+
+    def first(name):
+        return(raw.get(name.lower(), [None])[0])
+
+    def addresses(name):
+        return([(decode_header_value(realname), header_text(address)) for realname, address in getaddresses(raw.get(name.lower(), []))])
+
+    try:
+        date = parsedate_to_datetime(first('Date'))
+        if date.tzinfo is None:
+            date = date.replace(tzinfo=datetime.timezone.utc)
+    except (TypeError, ValueError, IndexError):
+        date = None
+
+    return({
+        'from': addresses('From'),
+        'to': addresses('To'),
+        'subject': decode_header_value(first('Subject')),
+        'message_id': header_text(first('Message-ID') or '<missing>').strip(),
+        'date': date,
+    })
+
+
+def store_blob(store, data, hash_func='sha256'):
+    """ Write data (bytes or an iterable of bytes chunks) into a content-addressed store.
+
+        Blobs are named store/<digest[:2]>/<digest>. In-memory data is hashed
+        first and only written when the blob is new, chunks are hashed while
+        they are written to a temporary file, which is dropped for duplicates.
+
+        Returns (digest, blob path, size).
+    """
+    store = ensure_directory_exists(store)
+    hash = hashlib.new(hash_func)
+
+    if isinstance(data, bytes):
+        hash.update(data)
+        digest = hash.hexdigest()
+        path = os.path.join(store, digest[:2], digest)
+        if not os.path.exists(path):
+            ensure_directory_exists(path, file=True)
+            fd, tmp = tempfile.mkstemp(dir=store, prefix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.chmod(tmp, 0o666 & ~UMASK)
+            os.replace(tmp, path)
+        return(digest, path, len(data))
+
+    size = 0
+    fd, tmp = tempfile.mkstemp(dir=store, prefix='.tmp')
+    with os.fdopen(fd, 'wb') as f:
+        for chunk in data:
+            hash.update(chunk)
+            f.write(chunk)
+            size += len(chunk)
+
+    digest = hash.hexdigest()
+    path = os.path.join(store, digest[:2], digest)
+    if os.path.exists(path):
+        os.remove(tmp)
+    else:
+        ensure_directory_exists(path, file=True)
+        os.chmod(tmp, 0o666 & ~UMASK)
+        os.replace(tmp, path)
+
+    return(digest, path, size)
+
+
+def link_blob(store, data, dst_filename):
+    """ Store data with store_blob() and hard link the blob to dst_filename.
+
+        Returns the meta.json attachment record, 'linked' is false when the link
+        failed (e.g. store on another file system) and only the blob exists.
+    """
+    digest, path, size = store_blob(store, data)
+    try:
+        os.link(path, dst_filename)
+        linked = True
+    except OSError as e:
+        logger.debug('Hard link failed: {}: {}'.format(dst_filename, e))
+        linked = False
+
+    return({
+        'filename': os.path.basename(dst_filename),
+        'sha256': digest,
+        'size': size,
+        'blob': os.path.relpath(path, store),
+        'linked': linked,
+    })
+
+
+class MessagePart(object):
+    """ A MIME part of a message, a view on the original message bytes.
+
+        payload is a zero-copy memoryview of the (transfer encoded) body,
+        iter_decoded() decodes it chunk by chunk.
+    """
+    def __init__(self, data, headers, start, end, depth=0):
+        self.data = data
+        self.headers = headers
+        self.start = start
+        self.end = end
+        self.depth = depth
+
+        self.type = headers.get_content_type()
+        self.charset = headers.get_content_charset()
+        self.disposition = (headers.get_content_disposition() or '').lower() or None
+        self.encoding = str(headers.get('Content-Transfer-Encoding', '7bit')).strip().lower()
+        filename = headers.get_filename() or headers.get_param('name')
+        if isinstance(filename, tuple):
+            filename = email.utils.collapse_rfc2231_value(filename)
+        self.filename = decode_header_value(filename) if filename else None
+
+    def __repr__(self):
+        return('MessagePart({}, filename={!r}, size={})'.format(self.type, self.filename, self.end - self.start))
+
+    @property
+    def payload(self):
+        return(memoryview(self.data)[self.start:self.end])
+
+    def iter_decoded(self, chunk_size=CHUNK_SIZE):
+        """ Yield the decoded body in chunks of about chunk_size bytes.
         """
-        lines = email_string.splitlines()
-        try:
-            while lines[0].strip() != '':
-                lines.pop(0)
-        except IndexError:
-            pass
+        # Slices of the data, a memoryview would pin an mmap open.
+        chunks = (self.data[offset:min(offset + chunk_size, self.end)] for offset in range(self.start, self.end, chunk_size))
 
-        return('\n'.join(lines[1:]))
+        if self.encoding == 'base64':
+            rest = b''
+            for chunk in chunks:
+                data = rest + chunk.translate(None, b' \t\r\n')
+                end = len(data) - len(data) % 4
+                rest = data[end:]
+                if end:
+                    yield binascii.a2b_base64(data[:end])
+            if rest.rstrip(b'='):
+                yield binascii.a2b_base64(rest + b'=' * (-len(rest) % 4))
 
+        elif self.encoding == 'quoted-printable':
+            rest = b''
+            for chunk in chunks:
+                data = rest + chunk
+                end = data.rfind(b'\n') + 1
+                rest = data[end:]
+                if end:
+                    yield binascii.a2b_qp(data[:end])
+            if rest:
+                yield binascii.a2b_qp(rest)
 
-    def extract_email_parts(email_string, dst=None, flatten=True, ascii=True):
-        """ Process an email, extract meta data, bodies and attachments.
-            The email can then be further processed with os.walk().
+        else:
+            for chunk in chunks:
+                yield chunk
+
+    def read(self):
+        """ Return the whole decoded body.
         """
-        message = parse.email.message_from_string(email_string)
+        return(b''.join(self.iter_decoded()))
 
-        from_ = parse.get_mail_addresses(message, 'from')
-        to = parse.get_mail_addresses(message, 'to')
+    def metadata(self):
+        """ Return the email_metadata() of a message/rfc822 part.
+        """
+        return(email_metadata(entity_header(self.data, self.start, self.end)))
 
-        # NOTE: parsedate don't take timezone into account!!!
-        # https://stackoverflow.com/questions/1790795/parsing-date-with-timezone-from-an-email
-        timestamp = datetime.datetime.fromtimestamp(time.mktime(parsedate(message['Date'])))
 
-        subject = message['Subject']
-        subject = ' '.join(part for part, encoding in decode_header(subject))
+def entity_header(data, start, end):
+    """ Return the header block (bytes) of the MIME entity data[start:end], at most HEADER_LIMIT bytes.
+    """
+    end = min(end, start + HEADER_LIMIT)
+    match = HEADER_END.search(data, start, end)
+    return(data[start:match.end() if match else end])
 
-        if ascii:
-            subject = unidecode(subject.decode('utf8'))
-            subject = ' '.join(subject.splitlines()).strip()
-            # subject = subject.decode('ascii', 'ignore')
 
-        header_parser = HeaderParser()
-        msg = header_parser.parsestr(email_string)
-        headers = dict(msg.items())
-        message_id = headers.get('Message-ID', '<missing>').strip()
+def parse_entity(data, start, end):
+    """ Return (headers, body start) of the MIME entity data[start:end].
+    """
+    if data[start:start + 1] == b'\n':
+        return(Message(), start + 1)
+    if data[start:start + 2] == b'\r\n':
+        return(Message(), start + 2)
 
-        logger.info('message_id: ' + message_id)
-        logger.info('subject: ' + subject)
+    match = HEADER_END.search(data, start, end)
+    header_end = match.start() + 1 if match else end
+    body_start = match.end() if match else end
+    headers = BytesHeaderParser().parsebytes(bytes(data[start:header_end]))
+    return(headers, body_start)
 
-        meta = {
-            'from': from_,
-            'to': to,
-            'timestamp': timestamp.strftime('%Y%m%dT%H%M%S'),
-            'subject': subject,
-            'message_id': message_id,
-        }
 
-        parts = parse.get_mail_parts(message)
-        if dst is None:
-            dst = tempfile.mkdtemp()
+def find_delimiter(data, delimiter, start, end):
+    """ Return the position of the line break before the next delimiter line in data[start:end], or -1.
+
+        A line that merely starts with the delimiter, e.g. a nested boundary
+        that extends the outer one, is not a delimiter line.
+    """
+    position = data.find(b'\n' + delimiter, start, end)
+    while position >= 0 and not DELIMITER_END.match(data, position + 1 + len(delimiter), end):
+        position = data.find(b'\n' + delimiter, position + 1, end)
+    return(position)
+
+
+def iter_parts(data, start=0, end=None, depth=0, descend=True):
+    """ Lazily yield the MessagePart's of a message, without copying or decoding bodies.
+
+        data is bytes or an mmap (see iter_message_file()). Multipart containers
+        are walked, not yielded. message/rfc822 parts are yielded and, with
+        descend=True, followed by their own parts.
+    """
+    if end is None:
+        end = len(data)
+
+    headers, body_start = parse_entity(data, start, end)
+    type_ = headers.get_content_type()
+
+    if type_.startswith('multipart/'):
+        boundary = headers.get_boundary()
+        if not boundary:
+            yield MessagePart(data, headers, body_start, end, depth)
+            return
+
+        delimiter = b'--' + boundary.encode('ascii', 'surrogateescape')
+        if data[body_start:body_start + len(delimiter)] == delimiter and DELIMITER_END.match(data, body_start + len(delimiter), end):
+            position = body_start
         else:
-            ensure_directory_exists(dst)
+            position = find_delimiter(data, delimiter, body_start, end)
+            if position < 0:
+                return
+            position += 1
 
-        dst_filename = valid_filename(os.path.join(dst, 'meta.json'))
-        logger.info('meta: ' + dst_filename)
-        with open(dst_filename, 'w') as f:
-            json.dump(meta, f)
+        while True:
+            after = position + len(delimiter)
+            if data[after:after + 2] == b'--':
+                break
+            line_end = data.find(b'\n', after, end)
+            if line_end < 0:
+                break
+            part_start = line_end + 1
 
-        for part in parts:
-            filename = part.filename
-            type_ = part.type.lower()
+            next_position = find_delimiter(data, delimiter, part_start, end)
+            if next_position < 0:
+                # Missing close delimiter, the part runs to the end.
+                part_end = next_position = end
+            else:
+                part_end = next_position
+                next_position += 1
+            # The line break before a delimiter belongs to the delimiter.
+            if part_end > part_start and data[part_end - 1:part_end] == b'\r':
+                part_end -= 1
 
-            if type_ in ['message/rfc822']:
-                if flatten:
-                    extract_email_parts(strip_header(part.get_payload()), dst=dst, flatten=flatten, ascii=ascii)
-                else:
-                    extract_email_parts(strip_header(part.get_payload()), dst=os.path.join(dst, filename), flatten=flatten, ascii=ascii)
+            for part in iter_parts(data, part_start, part_end, depth + 1, descend):
+                yield part
 
-            elif type_ in ['text/html', 'text/plain'] and part.disposition not in ['attachment']:
-                ext = {'text/html': '.html', 'text/plain': '.txt'}[type_]
-                dst_filename = valid_filename(os.path.join(dst, 'body' + ext))
-                logger.info('body: ' + dst_filename)
-                with open(dst_filename, 'wb') as f:
-                    f.write(part.get_payload())
+            if next_position >= end:
+                break
+            position = next_position
 
-            elif part.disposition in ['attachment'] or any([type_.startswith(prefix) for prefix in ['application', 'image']]):
-                ext = mimetypes.guess_extension(part.type or '')
-                dst_filename = valid_filename(os.path.join(dst, filename or 'noname' + ext), ascii=ascii)
-                logger.info('attachment: ' + dst_filename)
-                with open(dst_filename, 'wb') as f:
-                    f.write(part.get_payload())
+    elif type_ == 'message/rfc822':
+        yield MessagePart(data, headers, body_start, end, depth)
+        if descend:
+            for part in iter_parts(data, body_start, end, depth + 1, descend):
+                yield part
+
+    else:
+        yield MessagePart(data, headers, body_start, end, depth)
+
+
+@contextlib.contextmanager
+def iter_message_file(path, descend=True):
+    """ Context manager yielding iter_parts() over a memory mapped message file.
+
+        Only the pages touched are read, peak memory stays near the chunk size.
 
+        with iter_message_file(path) as parts:
+            for part in parts:
+                ...
+    """
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            yield iter([])
+            return
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            yield iter_parts(data, descend=descend)
+        finally:
+            data.close()
+
+
+def extract_parts(data, start, end, dst, flatten=True, ascii=True, store=None):
+    """ Extract meta data, bodies and attachments of the message data[start:end] into dst.
+    """
+    metadata = email_metadata(entity_header(data, start, end))
+    subject = metadata['subject']
+    if ascii:
+        subject = unidecode(subject)
+        subject = ' '.join(subject.splitlines()).strip()
+    date = metadata['date'].astimezone() if metadata['date'] else None
+
+    logger.info('message_id: ' + metadata['message_id'])
+    logger.info('subject: ' + subject)
+
+    meta = {
+        'from': metadata['from'],
+        'to': metadata['to'],
+        'timestamp': date.strftime('%Y%m%dT%H%M%S') if date else None,
+        'date': date.isoformat() if date else None,
+        'subject': subject,
+        'message_id': metadata['message_id'],
+    }
+
+    ensure_directory_exists(dst)
+    meta_filename = valid_filename(os.path.join(dst, 'meta.json'))
+    logger.info('meta: ' + meta_filename)
+    with open(meta_filename, 'w') as f:
+        json.dump(meta, f)
+
+    attachments = []
+    for part in iter_parts(data, start, end, descend=False):
+        type_ = part.type
+
+        if type_ in ['message/rfc822']:
+            nested_dst = dst if flatten else os.path.join(dst, part.filename or 'message')
+            extract_parts(data, part.start, part.end, nested_dst, flatten=flatten, ascii=ascii, store=store)
+
+        elif type_ in ['text/html', 'text/plain'] and part.disposition not in ['attachment']:
+            ext = {'text/html': '.html', 'text/plain': '.txt'}[type_]
+            dst_filename = valid_filename(os.path.join(dst, 'body' + ext))
+            logger.info('body: ' + dst_filename)
+            with open(dst_filename, 'wb') as f:
+                for chunk in part.iter_decoded():
+                    f.write(chunk)
+
+        elif part.disposition in ['attachment'] or any([type_.startswith(prefix) for prefix in ['application', 'image']]):
+            ext = mimetypes.guess_extension(type_) or ''
+            dst_filename = valid_filename(os.path.join(dst, part.filename or 'noname' + ext), ascii=ascii)
+            logger.info('attachment: ' + dst_filename)
+            if store:
+                attachments.append(link_blob(store, part.iter_decoded(), dst_filename))
             else:
-                logger.debug('Unknown type: filename: {}, disposition: {}, type: {}'.format(part.filename, part.disposition, part.type))
+                with open(dst_filename, 'wb') as f:
+                    for chunk in part.iter_decoded():
+                        f.write(chunk)
+
+        else:
+            logger.debug('Unknown type: filename: {}, disposition: {}, type: {}'.format(part.filename, part.disposition, type_))
 
+    if attachments:
+        meta['attachments'] = attachments
+        with open(meta_filename, 'w') as f:
+            json.dump(meta, f)
+
+
+def extract_email_file(message, dst=None, flatten=True, ascii=True, store=None):
+    """ Extract meta data, bodies and attachments of a message file (path) or bytes into dst.
+
+        Files are memory mapped and parts are decoded chunk by chunk straight to
+        disk, nested messages are walked in place. With store (a directory)
+        attachments are written once into a content-addressed store (see
+        store_blob()) and hard linked into dst, meta.json lists them with their
+        sha256 digest.
+    """
+    if dst is None:
+        dst = tempfile.mkdtemp()
+
+    if isinstance(message, (bytes, bytearray, mmap.mmap)):
+        extract_parts(message, 0, len(message), dst, flatten=flatten, ascii=ascii, store=store)
         return dst
 
+    with open(message, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return dst
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            extract_parts(data, 0, len(data), dst, flatten=flatten, ascii=ascii, store=store)
+        finally:
+            data.close()
 
-def text_email(from_='',
-               to=[],
-               cc=None,
-               bcc=None,
-               subject='',
-               body='',
-               files=None,
-               smtp_server='',
-               smtp_port=25,
-               smtp_username='',
-               smtp_password=''):
-    """ Generate a simple text email and send it to various recipients via an authenticated SMTP server.
+    return dst
+
+
+def extract_email_parts(email_string, dst=None, flatten=True, ascii=True, store=None):
+    """ Process an email, extract meta data, bodies and attachments.
+        The email can then be further processed with os.walk().
+
+        email_string is a str or bytes, see extract_email_file().
+    """
+    if isinstance(email_string, str):
+        email_string = email_string.encode('utf-8', 'surrogateescape')
+    return(extract_email_file(email_string, dst=dst, flatten=flatten, ascii=ascii, store=store))
+
+
+# Mailboxes opened by extract_mailbox() worker processes, by path.
+_mailboxes = {}
+
+
+def open_mailbox(path):
+    """ Open a Maildir (a directory) or mbox (a file) read-only.
+    """
+    if os.path.isdir(path):
+        return(mailbox.Maildir(path, factory=None, create=False))
+    return(mailbox.mbox(path, factory=None, create=False))
+
+
+def header_message_id(data):
+    """ Return the Message-ID of a message (bytes), '' when it is missing.
+    """
+    return(str(BytesHeaderParser().parsebytes(header_block(data))['Message-ID'] or '').strip())
+
+
+def message_directory(dst, message_id, data):
+    """ Return the deterministic extraction directory of a message.
+
+        Keyed on the Message-ID, or the message contents when it is missing.
+    """
+    if message_id:
+        digest = hashlib.sha1(message_id.encode('utf-8', 'surrogateescape')).hexdigest()
+    else:
+        digest = hashlib.sha1(data).hexdigest()
+    return(os.path.join(dst, digest[:2], digest))
+
+
+# Written into a message directory by extract_mailbox_message() once extraction is complete.
+EXTRACTED_FILENAME = '.extracted.json'
+
+
+def extract_mailbox_message(path, key, dst, ascii=True, store=None):
+    """ Extract one mailbox message into its message_directory(), in a worker process.
+
+        Returns (extracted, index record), extracted is False when the message
+        was already extracted. The record is written last, into
+        EXTRACTED_FILENAME, a directory without it is an interrupted
+        extraction and is extracted again.
+    """
+    if path not in _mailboxes:
+        _mailboxes[path] = open_mailbox(path)
+    data = _mailboxes[path].get_bytes(key)
+
+    directory = message_directory(dst, header_message_id(data), data)
+    extracted_filename = os.path.join(directory, EXTRACTED_FILENAME)
+    if os.path.exists(extracted_filename):
+        with open(extracted_filename) as f:
+            return(False, json.load(f))
+
+    # Left over from an interrupted run.
+    shutil.rmtree(directory, ignore_errors=True)
+
+    extract_email_file(data, dst=directory, flatten=True, ascii=ascii, store=store)
+    with open(os.path.join(directory, 'meta.json')) as f:
+        meta = json.load(f)
+
+    meta['key'] = key
+    meta['path'] = os.path.relpath(directory, dst)
+    with open(extracted_filename + '.tmp', 'w') as f:
+        json.dump(meta, f)
+    os.replace(extracted_filename + '.tmp', extracted_filename)
+    return(True, meta)
+
+
+def mailbox_message_directory(mbox, key, dst):
+    """ Return the message_directory() of a mailbox message, only its header is read when it has a Message-ID.
+    """
+    with contextlib.closing(mbox.get_file(key)) as f:
+        head = f.read(HEADER_LIMIT)
+    message_id = header_message_id(head) if HEADER_END.search(head) else None
+    if message_id:
+        return(message_directory(dst, message_id, None))
+
+    data = mbox.get_bytes(key)
+    return(message_directory(dst, header_message_id(data), data))
+
+
+def indexed_paths(filename):
+    """ Return the message paths recorded in an extract_mailbox() index.jsonl.
+    """
+    paths = set()
+    try:
+        with open(filename) as f:
+            for line in f:
+                try:
+                    paths.add(json.loads(line)['path'])
+                except (ValueError, KeyError, TypeError):
+                    # A line cut short by an interrupted run.
+                    pass
+    except IOError:
+        pass
+    return(paths)
+
+
+def extract_mailbox(path, dst, workers=None, ascii=True, store=None, batch_size=1000):
+    """ Extract all messages of a Maildir or mbox with extract_email_file() in parallel.
+
+        Every message goes to its own directory under dst (see
+        message_directory()), one JSON record per message is appended to
+        dst/index.jsonl. Messages already extracted are skipped, and their
+        record is added to the index when an interrupted run missed it, so
+        an interrupted run can be resumed. Messages with the same Message-ID
+        are extracted once, later copies are skipped. store is passed on to
+        extract_email_file() to deduplicate attachments.
+
+        Returns {'extracted': n, 'skipped': n, 'failed': n, 'seconds': s, 'rate': messages/s}.
+    """
+    ensure_directory_exists(dst)
+    mbox = open_mailbox(path)
+    keys = mbox.keys()
+    stats = {'extracted': 0, 'skipped': 0, 'failed': 0}
+    start = time.time()
+    index_filename = os.path.join(dst, 'index.jsonl')
+    indexed = indexed_paths(index_filename)
+
+    with open(index_filename, 'a') as index:
+        if index.tell():
+            with open(index_filename, 'rb') as f:
+                f.seek(-1, os.SEEK_END)
+                if f.read() != b'\n':
+                    # Terminate a line cut short by an interrupted run.
+                    index.write('\n')
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            # Submit batch_size messages at a time to bound the pending futures.
+            keys = iter(keys)
+            held = []
+            while True:
+                batch = held + list(itertools.islice(keys, max(batch_size - len(held), 1)))
+                if not batch:
+                    break
+
+                # Messages sharing a Message-ID share a directory, hold duplicates
+                # back to a later batch, by which time the first one is extracted.
+                directories = set()
+                unique = []
+                held = []
+                for key in batch:
+                    directory = mailbox_message_directory(mbox, key, dst)
+                    if directory in directories:
+                        held.append(key)
+                    else:
+                        directories.add(directory)
+                        unique.append(key)
+
+                futures = {executor.submit(extract_mailbox_message, path, key, dst, ascii, store): key for key in unique}
+                for future in concurrent.futures.as_completed(futures):
+                    try:
+                        extracted, meta = future.result()
+                    except Exception as e:
+                        logger.warning('Failed: {}: {}'.format(futures[future], e))
+                        stats['failed'] += 1
+                        continue
+
+                    if extracted:
+                        stats['extracted'] += 1
+                    else:
+                        stats['skipped'] += 1
+                    if meta['path'] not in indexed:
+                        index.write(json.dumps(meta) + '\n')
+                        indexed.add(meta['path'])
+
+                index.flush()
+                seconds = time.time() - start
+                logger.info('Extracted: {extracted}, skipped: {skipped}, failed: {failed}'.format(**stats) + ', {:.1f} messages/s'.format(stats['extracted'] / seconds))
+
+    stats['seconds'] = time.time() - start
+    stats['rate'] = stats['extracted'] / (stats['seconds'] or 1)
+    return(stats)
+
+
+def message_text(data):
+    """ Return (email_metadata(), text) of a message, text is its decoded text bodies.
+
+        HTML bodies are reduced to text, attachments are not decoded.
+    """
+    metadata = email_metadata(entity_header(data, 0, len(data)))
+    texts = []
+    for part in iter_parts(data):
+        if part.type not in ['text/plain', 'text/html'] or part.disposition in ['attachment']:
+            continue
+        try:
+            text = part.read().decode(part.charset or 'utf-8', 'replace')
+        except LookupError:
+            text = part.read().decode('utf-8', 'replace')
+        if part.type == 'text/html':
+            text = html.unescape(HTML_TAG.sub(' ', HTML_SKIP.sub(' ', text)))
+        texts.append(text)
+
+    return(metadata, '\n'.join(texts))
+
+
+def index_record(path):
+    """ Return the MaildirIndex record of a message file, in a worker process.
+    """
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            metadata, text = email_metadata(b''), ''
+        else:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                metadata, text = message_text(data)
+            finally:
+                data.close()
+
+    def addresses(values):
+        return(', '.join(email.utils.formataddr(value) for value in values))
+
+    return({
+        'path': path,
+        'sender': addresses(metadata['from']),
+        'recipients': addresses(metadata['to']),
+        'subject': metadata['subject'],
+        'message_id': metadata['message_id'],
+        'date': metadata['date'].isoformat() if metadata['date'] else None,
+        'body': text,
+    })
+
+
+def maildir_files(path):
+    """ Yield the message files in the cur/ and new/ directories of a Maildir, subfolders included.
+    """
+    for root, directories, filenames in os.walk(path):
+        if os.path.basename(root) in ['cur', 'new']:
+            for filename in filenames:
+                if not filename.startswith('.'):
+                    yield os.path.join(root, filename)
+            directories[:] = []
+
+
+class MaildirIndex(object):
+    """ Full text index over a Maildir (e.g. an imap_tool dump), sqlite FTS5.
+
+        with MaildirIndex('~/mail/.index.sqlite') as index:
+            index.update('~/mail')
+            for result in index.search('subject:invoice AND 2019'):
+                print(result['path'], result['subject'])
+
+        Senders, recipients, subjects and decoded text bodies are indexed.
+        update() only parses new or changed files (by mtime, inode and size),
+        files renamed by a mail client (new/ -> cur/, flags) keep their entry
+        and deleted files are removed. Parsing runs in a process pool.
+        Queries use the FTS5 syntax, columns are sender, recipients, subject
+        and body.
+    """
+    def __init__(self, path):
+        self.path = os.path.expanduser(path)
+
+        ensure_directory_exists(self.path, file=True)
+        self._connection = sqlite3.connect(self.path, isolation_level=None)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('PRAGMA synchronous=NORMAL')
+        self._connection.execute("""
+            CREATE TABLE IF NOT EXISTS files (
+                id INTEGER PRIMARY KEY,
+                path TEXT UNIQUE,
+                inode INTEGER,
+                mtime REAL,
+                size INTEGER
+            )""")
+        self._connection.execute('CREATE INDEX IF NOT EXISTS files_inode ON files (inode)')
+        self._connection.execute("""
+            CREATE VIRTUAL TABLE IF NOT EXISTS messages USING fts5 (
+                sender,
+                recipients,
+                subject,
+                body,
+                message_id UNINDEXED,
+                date UNINDEXED
+            )""")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def add(self, record, stat):
+        """ Index a record of index_record(), replacing an older version of the file.
+        """
+        self.remove(record['path'])
+        cursor = self._connection.execute('INSERT INTO files (path, inode, mtime, size) VALUES (?, ?, ?, ?)',
+                                          (record['path'], stat.st_ino, stat.st_mtime, stat.st_size))
+        self._connection.execute('INSERT INTO messages (rowid, sender, recipients, subject, body, message_id, date) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                 (cursor.lastrowid, record['sender'], record['recipients'], record['subject'], record['body'], record['message_id'], record['date']))
+
+    def remove(self, path):
+        """ Remove a file from the index.
+        """
+        for (id_,) in self._connection.execute('SELECT id FROM files WHERE path = ?', (path,)).fetchall():
+            self._connection.execute('DELETE FROM messages WHERE rowid = ?', (id_,))
+            self._connection.execute('DELETE FROM files WHERE id = ?', (id_,))
+
+    def update(self, maildir, workers=None, batch_size=1000):
+        """ Bring the index up to date with the files of maildir.
+
+            Returns {'added': n, 'renamed': n, 'removed': n, 'unchanged': n, 'failed': n, 'seconds': s}.
+        """
+        start = time.time()
+        maildir = os.path.abspath(os.path.expanduser(maildir))
+        stats = {'added': 0, 'renamed': 0, 'removed': 0, 'unchanged': 0, 'failed': 0}
+
+        known = {}
+        for id_, path, inode, mtime, size in self._connection.execute('SELECT id, path, inode, mtime, size FROM files'):
+            known[path] = (id_, inode, mtime, size)
+        by_inode = {(inode, mtime, size): (path, id_) for path, (id_, inode, mtime, size) in known.items()}
+
+        changed = {}
+        seen = set()
+        self._connection.execute('BEGIN')
+        for path in maildir_files(maildir):
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            seen.add(path)
+            key = (stat.st_ino, stat.st_mtime, stat.st_size)
+            if path in known and known[path][1:] == key:
+                stats['unchanged'] += 1
+            elif path not in known and key in by_inode and by_inode[key][0] not in seen and not os.path.exists(by_inode[key][0]):
+                # Renamed by a mail client, same file.
+                old_path, id_ = by_inode.pop(key)
+                self._connection.execute('UPDATE files SET path = ? WHERE id = ?', (path, id_))
+                known.pop(old_path, None)
+                seen.add(old_path)
+                stats['renamed'] += 1
+            else:
+                changed[path] = stat
+
+        for path in set(known) - seen:
+            if path.startswith(maildir + os.sep):
+                self.remove(path)
+                stats['removed'] += 1
+        self._connection.execute('COMMIT')
+
+        paths = list(changed)
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            for offset in range(0, len(paths), batch_size):
+                batch = paths[offset:offset + batch_size]
+                futures = {executor.submit(index_record, path): path for path in batch}
+                self._connection.execute('BEGIN')
+                for future in concurrent.futures.as_completed(futures):
+                    try:
+                        record = future.result()
+                    except Exception as e:
+                        logger.warning('Failed: {}: {}'.format(futures[future], e))
+                        stats['failed'] += 1
+                        continue
+                    self.add(record, changed[record['path']])
+                    stats['added'] += 1
+                self._connection.execute('COMMIT')
+                logger.info('Indexed: {} of {}'.format(offset + len(batch), len(paths)))
+
+        stats['seconds'] = time.time() - start
+        return(stats)
+
+    def search(self, query, limit=20):
+        """ Return the best matches for an FTS5 query, a list of dicts, best first.
+        """
+        rows = self._connection.execute("""
+            SELECT files.path, messages.sender, messages.subject, messages.date, messages.message_id,
+                   snippet(messages, 3, '[', ']', '...', 12)
+            FROM messages JOIN files ON files.id = messages.rowid
+            WHERE messages MATCH ? ORDER BY rank LIMIT ?""", (query, limit)).fetchall()
+        return([dict(zip(['path', 'sender', 'subject', 'date', 'message_id', 'snippet'], row)) for row in rows])
+
+    def stats(self):
+        """ Return the number of indexed messages.
+        """
+        return({'messages': self._connection.execute('SELECT count(*) FROM files').fetchone()[0]})
+
+    def close(self):
+        self._connection.close()
+
+
+def strip_header(email_string):
+    """ Remove content-description/type/disposition header.
+    """
+    lines = email_string.splitlines()
+    try:
+        while lines[0].strip() != '':
+            lines.pop(0)
+    except IndexError:
+        pass
+
+    return('\n'.join(lines[1:]))
+
+
+def dot_stuffed(chunks):
+    """ Yield message bytes chunks as whole, dot-stuffed lines for the SMTP DATA command.
+
+        The last line is terminated with CRLF if needed.
+    """
+    tail = b''
+    for chunk in chunks:
+        data = tail + chunk
+        end = data.rfind(b'\n') + 1
+        tail = data[end:]
+        if end:
+            yield DOT_STUFF.sub(b'..', data[:end])
+
+    if tail:
+        yield DOT_STUFF.sub(b'..', tail) + b'\r\n'
+
+
+class SMTPSender(object):
+    """ Send messages over reusable authenticated SMTP connections.
+
+        with SMTPSender(host, port, username, password, connections=4) as sender:
+            sender.send(from_, to, message)
+            failures = sender.send_many((from_, to, message) for ...)
+
+        Connections are kept alive between messages (one EHLO, STARTTLS and LOGIN
+        per connection), re-established when the server disconnects and recycled
+        after max_messages messages.
+    """
+    def __init__(self, host='', port=25, username='', password='', starttls=True, connections=1, max_messages=100, timeout=60):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.starttls = starttls
+        self.connections = connections
+        self.max_messages = max_messages
+        self.timeout = timeout
+
+        # Connection slots, None until the slot is first used.
+        self._slots = queue.LifoQueue()
+        for _ in range(connections):
+            self._slots.put(None)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def connect(self):
+        """ Return a new authenticated SMTP connection.
+        """
+        smtp = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+        smtp.ehlo()
+        if self.starttls:
+            smtp.starttls()
+            smtp.ehlo()
+        if self.username:
+            smtp.login(self.username, self.password)
+
+        logger.debug('SMTP connected: {}:{}'.format(self.host, self.port))
+        return(smtp)
+
+    @staticmethod
+    def disconnect(smtp):
+        """ Quit an SMTP connection, ignoring errors.
+        """
+        try:
+            smtp.quit()
+        except (smtplib.SMTPException, OSError):
+            smtp.close()
+
+    def send(self, from_, to, message):
+        """ Send a message to a list of recipients.
+
+            message is an email.message.Message, str or bytes, or, to stream large
+            messages, a binary file or an iterable of bytes chunks (e.g.
+            iter_html_message()) with CRLF line endings.
+
+            Returns the recipients refused by the server, see smtplib.SMTP.sendmail().
+        """
+        if isinstance(message, Message):
+            message = message.as_string()
+
+        if isinstance(message, (str, bytes)):
+            def sendmail(smtp):
+                return(smtp.sendmail(from_, to, message))
+        elif hasattr(message, 'read'):
+            start = message.tell()
+
+            def sendmail(smtp):
+                message.seek(start)
+                return(self.send_data(smtp, from_, to, iter(functools.partial(message.read, CHUNK_SIZE), b'')))
+        else:
+            # A chunk iterator can only be replayed if nothing was consumed.
+            chunks = iter(message)
+            consumed = []
+
+            def stream():
+                for chunk in chunks:
+                    consumed.append(True)
+                    yield chunk
+
+            def sendmail(smtp):
+                if consumed:
+                    raise smtplib.SMTPServerDisconnected('Message stream partially sent.')
+                return(self.send_data(smtp, from_, to, stream()))
+
+        slot = self._slots.get()
+        try:
+            if slot is not None and slot[1] >= self.max_messages:
+                self.disconnect(slot[0])
+                slot = None
+
+            for attempt in range(2):
+                if slot is None:
+                    slot = [self.connect(), 0]
+                try:
+                    refused = sendmail(slot[0])
+                    break
+                except smtplib.SMTPServerDisconnected:
+                    slot[0].close()
+                    slot = None
+                    if attempt:
+                        raise
+                    logger.info('SMTP server disconnected, reconnecting.')
+                except smtplib.SMTPException:
+                    raise
+                except Exception:
+                    # E.g. a chunk iterator failing halfway through DATA, the connection is unusable.
+                    slot[0].close()
+                    slot = None
+                    raise
+
+            slot[1] += 1
+        finally:
+            self._slots.put(slot)
+
+        return(refused)
+
+    @staticmethod
+    def send_data(smtp, from_, to, chunks):
+        """ smtplib.SMTP.sendmail() streaming the message from bytes chunks into the DATA command.
+
+            Lines are dot-stuffed as they are sent, only one chunk is held in memory.
+        """
+        def reset():
+            try:
+                smtp.rset()
+            except smtplib.SMTPServerDisconnected:
+                pass
+
+        smtp.ehlo_or_helo_if_needed()
+        code, response = smtp.mail(from_)
+        if code != 250:
+            reset()
+            raise smtplib.SMTPSenderRefused(code, response, from_)
+
+        refused = {}
+        for address in to:
+            code, response = smtp.rcpt(address)
+            if code not in (250, 251):
+                refused[address] = (code, response)
+        if len(refused) == len(to):
+            reset()
+            raise smtplib.SMTPRecipientsRefused(refused)
+
+        code, response = smtp.docmd('data')
+        if code != 354:
+            reset()
+            raise smtplib.SMTPDataError(code, response)
+
+        # The end of data marker goes out with the last lines, a separate small
+        # write is held back by Nagle's algorithm until the previous one is acknowledged.
+        pending = b''
+        for data in dot_stuffed(chunks):
+            if pending:
+                smtp.send(pending)
+            pending = data
+        smtp.send(pending + b'.\r\n')
+
+        code, response = smtp.getreply()
+        if code != 250:
+            raise smtplib.SMTPDataError(code, response)
+
+        return(refused)
+
+    def send_many(self, messages):
+        """ Send (from_, to, message) tuples in parallel over the connections.
+
+            Returns a list of (index, exception) for the messages that failed.
+        """
+        failures = []
+        messages = iter(enumerate(messages))
+        lock = threading.Lock()
+
+        def worker():
+            while True:
+                with lock:
+                    try:
+                        index, (from_, to, message) = next(messages)
+                    except StopIteration:
+                        return
+                try:
+                    self.send(from_, to, message)
+                except (smtplib.SMTPException, OSError) as e:
+                    logger.warning('Message {} failed: {}'.format(index, e))
+                    failures.append((index, e))
+
+        threads = [threading.Thread(target=worker) for _ in range(self.connections)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        return(sorted(failures, key=lambda failure: failure[0]))
+
+    def close(self):
+        """ Quit all open connections.
+        """
+        slots = []
+        while not self._slots.empty():
+            slots.append(self._slots.get())
+
+        for slot in slots:
+            if slot is not None:
+                self.disconnect(slot[0])
+            self._slots.put(None)
+
+
+def recipients(to, cc=None, bcc=None):
+    """ Return the envelope recipients of a message.
+    """
+    return(list(to) + list(cc or []) + list(bcc or []))
+
+
+def deliver(from_, to, message, smtp_server='', smtp_port=25, smtp_username='', smtp_password='', sender=None):
+    """ Send a message with sender (an SMTPSender) or over a new SMTP connection.
+    """
+    if sender is None:
+        sender = SMTPSender(smtp_server, smtp_port, smtp_username, smtp_password, max_messages=1)
+        try:
+            return(sender.send(from_, to, message))
+        finally:
+            sender.close()
+
+    return(sender.send(from_, to, message))
+
+
+def text_message(from_='',
+                 to=[],
+                 cc=None,
+                 subject='',
+                 body='',
+                 files=None):
+    """ Generate a simple text email message.
     """
     message = MIMEMultipart()
     message['To'] = COMMASPACE.join(to)
@@ -158,38 +1194,91 @@ def text_email(from_='',
             if mime_type:
                 part.set_type(mime_type)
 
-            part.set_payload(open(filepath, 'rb').read())
+            with open(filepath, 'rb') as f:
+                part.set_payload(f.read())
             encode_base64(part)
             part.add_header('Content-Disposition', 'attachment; filename="%s"' % os.path.basename(filepath))
             message.attach(part)
 
-    smtp = smtplib.SMTP(smtp_server, smtp_port)
-    smtp.ehlo()
-    smtp.starttls()
-    if smtp_username:
-        smtp.login(smtp_username, smtp_password)
-    if cc:
-        to += cc
-    if bcc:
-        to += bcc
-    smtp.sendmail(from_, to, message.as_string())
-    smtp.quit()
+    return(message)
 
 
-def html_email(from_='',
+def text_email(from_='',
                to=[],
                cc=None,
                bcc=None,
                subject='',
-               text_body='',
-               html_body='',
+               body='',
                files=None,
-               images=[],
                smtp_server='',
                smtp_port=25,
                smtp_username='',
-               smtp_password=''):
-    """ Generate a HTML email and send it to various recipients via an authenticated SMTP server.
+               smtp_password='',
+               sender=None,
+               stream=False):
+    """ Generate a simple text email and send it to various recipients via an authenticated SMTP server.
+
+        Pass sender (an SMTPSender) to reuse its connections.
+        With stream=True attachments are base64 encoded from disk while sending,
+        memory use does not depend on the attachment sizes.
+    """
+    if stream:
+        message = iter_text_message(from_=from_, to=to, cc=cc, subject=subject, body=body, files=files)
+    else:
+        message = text_message(from_=from_, to=to, cc=cc, subject=subject, body=body, files=files)
+    deliver(from_, recipients(to, cc, bcc), message, smtp_server, smtp_port, smtp_username, smtp_password, sender)
+
+
+def image_part(image, count):
+    """ Return an inline image part, image is a path or a (filename, data) tuple.
+
+        Referenced from the HTML body as src="cid:image<count>".
+    """
+    if isinstance(image, str):
+        with open(image, 'rb') as image_file:
+            image_data = image_file.read()
+        part = MIMEImage(image_data)
+        image_filename = os.path.basename(image)
+    elif isinstance(image, (tuple)):
+        part = MIMEImage(image[1])
+        image_filename = image[0]
+
+    mime_type = mimetypes.guess_type(image_filename)[0]
+    if mime_type:
+        part.set_type(mime_type)
+
+    part.add_header('Content-Location', image_filename)
+    part.add_header('Content-Disposition', 'inline', filename=image_filename)
+    part.add_header('Content-ID', '<image{}>'.format(count))
+    return(part)
+
+
+def attachment_part(attachment):
+    """ Return a base64 encoded "download" attachment part for a file.
+    """
+    part = MIMEBase('application', 'octet-stream')  # 'octet-stream' filtered by MS Exchange.
+    with open(attachment, 'rb') as attachment_file:
+        attachment_data = attachment_file.read()
+
+    mime_type = mimetypes.guess_type(attachment)[0]
+    if mime_type:
+        part.set_type(mime_type)
+
+    part.set_payload(attachment_data)
+    encode_base64(part)
+    part.add_header('Content-Disposition', 'attachment; filename="%s"' % os.path.basename(attachment))
+    return(part)
+
+
+def html_message(from_='',
+                 to=[],
+                 cc=None,
+                 subject='',
+                 text_body='',
+                 html_body='',
+                 files=None,
+                 images=[]):
+    """ Generate a HTML email message.
 
         +-------------------------------------------------------+
         | multipart/mixed                                       |
@@ -252,52 +1341,848 @@ def html_email(from_='',
     related.attach(body)
 
     for count, image in enumerate(images, 1):
-        if isinstance(image, basestring):
-            with open(image, 'rb') as image_file:
-                image_data = image_file.read()
-            image_part = MIMEImage(image_data)
-            image_filename = os.path.basename(image)
-        elif isinstance(image, (tuple)):
-            image_part = MIMEImage(image[1])
-            image_filename = image[0]
-
-        mime_type = mimetypes.guess_type(image_filename)[0]
-        if mime_type:
-            image_part.set_type(mime_type)
-
-        image_part.add_header('Content-Location', image_filename)
-        image_part.add_header('Content-Disposition', 'inline', filename=image_filename)
-        image_part.add_header('Content-ID', '<image{}>'.format(count))
-        related.attach(image_part)
+        related.attach(image_part(image, count))
 
     message.attach(related)
 
     if files:
         for attachment in files:
-            part = MIMEBase('application', 'octet-stream')  # 'octet-stream' filtered by MS Exchange.
-            with open(attachment, 'rb') as attachment_file:
-                attachment_data = attachment_file.read()
+            message.attach(attachment_part(attachment))
 
-            mime_type = mimetypes.guess_type(attachment)[0]
-            if mime_type:
-                part.set_type(mime_type)
+    return(message)
+
+
+def html_email(from_='',
+               to=[],
+               cc=None,
+               bcc=None,
+               subject='',
+               text_body='',
+               html_body='',
+               files=None,
+               images=[],
+               smtp_server='',
+               smtp_port=25,
+               smtp_username='',
+               smtp_password='',
+               sender=None,
+               stream=False):
+    """ Generate a HTML email and send it to various recipients via an authenticated SMTP server.
+
+        See html_message() for the structure of the message.
+        Pass sender (an SMTPSender) to reuse its connections.
+        With stream=True attachments are base64 encoded from disk while sending,
+        memory use does not depend on the attachment sizes.
+    """
+    if stream:
+        message = iter_html_message(from_=from_, to=to, cc=cc, subject=subject, text_body=text_body, html_body=html_body, files=files, images=images)
+    else:
+        message = html_message(from_=from_, to=to, cc=cc, subject=subject, text_body=text_body, html_body=html_body, files=files, images=images)
+    deliver(from_, recipients(to, cc, bcc), message, smtp_server, smtp_port, smtp_username, smtp_password, sender)
 
-            part.set_payload(attachment_data)
-            encode_base64(part)
-            part.add_header('Content-Disposition', 'attachment; filename="%s"' % os.path.basename(attachment))
-            message.attach(part)
 
-    smtp = smtplib.SMTP(smtp_server, smtp_port)
-    smtp.ehlo()
-    smtp.starttls()
-    if smtp_username:
-        smtp.login(smtp_username, smtp_password)
+def make_boundary():
+    """ Return a unique MIME multipart boundary.
+    """
+    return('===============' + uuid.uuid4().hex + '==')
+
+
+def header_bytes(headers):
+    """ Serialize the header block of a Message (CRLF line endings, RFC 2047 encoded).
+    """
+    policy = email.policy.SMTP
+    chunks = [policy.fold_binary(name, policy.header_factory(name, str(value))) for name, value in headers.items()]
+    chunks.append(b'\r\n')
+    return(b''.join(chunks))
+
+
+def iter_multipart(headers, boundary, parts):
+    """ Yield a serialized multipart entity from its header Message and parts.
+
+        Parts are bytes or iterables of bytes chunks (streamed).
+    """
+    delimiter = b'--' + boundary.encode('ascii')
+    yield header_bytes(headers)
+    for part in parts:
+        yield delimiter + b'\r\n'
+        if isinstance(part, bytes):
+            yield part
+        else:
+            for chunk in part:
+                yield chunk
+        yield b'\r\n'
+    yield delimiter + b'--\r\n'
+
+
+def multipart_bytes(headers, boundary, parts):
+    """ Serialize a multipart entity from its header Message and serialized (bytes) parts.
+    """
+    return(b''.join(iter_multipart(headers, boundary, parts)))
+
+
+def multipart_headers(subtype, boundary):
+    """ Return a header-only Message for a multipart entity.
+    """
+    headers = Message(policy=email.policy.SMTP)
+    headers['Content-Type'] = 'multipart/{}'.format(subtype)
+    headers.set_param('boundary', boundary)
+    return(headers)
+
+
+def message_headers(from_, to, cc, subject, boundary):
+    """ Return the top-level multipart/mixed headers of a message.
+    """
+    headers = multipart_headers('mixed', boundary)
+    headers['MIME-Version'] = '1.0'
+    headers['To'] = COMMASPACE.join(to)
     if cc:
-        to += cc
-    if bcc:
-        to += bcc
-    smtp.sendmail(from_, to, message.as_string())
-    smtp.quit()
+        headers['Cc'] = COMMASPACE.join(cc)
+    headers['From'] = from_
+    headers['Subject'] = subject
+    headers['Date'] = formatdate(localtime=True)
+    headers['Message-ID'] = make_msgid()
+    return(headers)
+
+
+def alternative_bytes(text_body, html_body):
+    """ Return the serialized multipart/alternative text and HTML bodies.
+    """
+    body = MIMEMultipart('alternative')
+    body.attach(MIMEText(text_body, 'plain'))
+    body.attach(MIMEText(html_body, 'html'))
+    return(body.as_bytes(policy=email.policy.SMTP))
+
+
+def iter_attachment(attachment, chunk_size=CHUNK_SIZE):
+    """ Yield a serialized "download" attachment part, base64 encoded from disk chunk by chunk.
+
+        Equivalent to attachment_part(), without reading the whole file.
+    """
+    part = Message()
+    mime_type = mimetypes.guess_type(attachment)[0] or 'application/octet-stream'
+    part['Content-Type'] = mime_type
+    part['MIME-Version'] = '1.0'
+    part['Content-Transfer-Encoding'] = 'base64'
+    part['Content-Disposition'] = 'attachment; filename="%s"' % os.path.basename(attachment)
+    yield header_bytes(part)
+
+    # Whole 76 character base64 lines per chunk.
+    chunk_size = max(chunk_size - chunk_size % 57, 57)
+    with open(attachment, 'rb') as f:
+        for data in iter(functools.partial(f.read, chunk_size), b''):
+            yield base64.encodebytes(data).replace(b'\n', b'\r\n')
+
+
+def iter_text_message(from_='',
+                      to=[],
+                      cc=None,
+                      subject='',
+                      body='',
+                      files=None,
+                      chunk_size=CHUNK_SIZE):
+    """ Yield a text_message() as bytes chunks, attachments are streamed from disk.
+    """
+    mixed = make_boundary()
+    parts = [MIMEText(body).as_bytes(policy=email.policy.SMTP)]
+    parts.extend([iter_attachment(attachment, chunk_size) for attachment in files or []])
+    return(iter_multipart(message_headers(from_, to, cc, subject, mixed), mixed, parts))
+
+
+def iter_html_message(from_='',
+                      to=[],
+                      cc=None,
+                      subject='',
+                      text_body='',
+                      html_body='',
+                      files=None,
+                      images=[],
+                      chunk_size=CHUNK_SIZE):
+    """ Yield a html_message() as bytes chunks, attachments are streamed from disk.
+
+        Inline images are expected to be small and are encoded in memory.
+    """
+    mixed = make_boundary()
+    related = make_boundary()
+    parts = [alternative_bytes(text_body, html_body)]
+    parts.extend([image_part(image, count).as_bytes(policy=email.policy.SMTP) for count, image in enumerate(images, 1)])
+    parts = [multipart_bytes(multipart_headers('related', related), related, parts)]
+    parts.extend([iter_attachment(attachment, chunk_size) for attachment in files or []])
+    return(iter_multipart(message_headers(from_, to, cc, subject, mixed), mixed, parts))
+
+
+class MessageTemplate(object):
+    """ Build a HTML email once and render it for many recipients.
+
+        template = MessageTemplate(from_, subject='Report for $name', text_body=..., html_body=..., files=[...])
+        with SMTPSender(host, port, username, password) as sender:
+            for to, name in people:
+                template.send(sender, [to], fields={'name': name})
+
+        The structure is the one of html_message(). Attachments and inline images
+        are read and base64 encoded once, rendering a message only generates the
+        headers (To, Cc, Date, Message-ID) and, when fields are given, the text
+        and HTML bodies with $field placeholders substituted (string.Template).
+    """
+    def __init__(self, from_='', subject='', text_body='', html_body='', files=None, images=[]):
+        self.from_ = from_
+        self.subject = subject
+        self.text_body = text_body
+        self.html_body = html_body
+
+        self._mixed = make_boundary()
+        self._related = make_boundary()
+        self._images = [image_part(image, count).as_bytes(policy=email.policy.SMTP) for count, image in enumerate(images, 1)]
+        self._files = [attachment_part(attachment).as_bytes(policy=email.policy.SMTP) for attachment in files or []]
+        self._related_bytes = None
+
+    def related_bytes(self, fields=None):
+        """ Return the serialized multipart/related part (bodies and inline images).
+        """
+        if not fields and self._related_bytes is not None:
+            return(self._related_bytes)
+
+        text_body = self.text_body
+        html_body = self.html_body
+        if fields:
+            text_body = string.Template(text_body).safe_substitute(fields)
+            html_body = string.Template(html_body).safe_substitute(fields)
+
+        parts = [alternative_bytes(text_body, html_body)] + self._images
+        related = multipart_bytes(multipart_headers('related', self._related), self._related, parts)
+
+        if not fields:
+            self._related_bytes = related
+        return(related)
+
+    def render(self, to, cc=None, fields=None):
+        """ Return the serialized message (bytes, CRLF line endings) for the recipients.
+        """
+        subject = self.subject
+        if fields:
+            subject = string.Template(subject).safe_substitute(fields)
+
+        headers = message_headers(self.from_, to, cc, subject, self._mixed)
+        return(multipart_bytes(headers, self._mixed, [self.related_bytes(fields)] + self._files))
+
+    def send(self, sender, to, cc=None, bcc=None, fields=None):
+        """ Render and send the message with sender (an SMTPSender).
+        """
+        return(sender.send(self.from_, recipients(to, cc, bcc), self.render(to, cc, fields)))
+
+
+class AsyncSMTP(object):
+    """ Minimal asyncio SMTP client.
+
+        Supports EHLO, STARTTLS (Python 3.7+, use use_tls=True for implicit TLS
+        on older versions), AUTH PLAIN/LOGIN and ESMTP PIPELINING of
+        MAIL FROM, RCPT TO and DATA when the server advertises it.
+    """
+    def __init__(self, host='', port=25, use_tls=False, timeout=60):
+        self.host = host
+        self.port = port
+        self.use_tls = use_tls
+        self.timeout = timeout
+        self.features = {}
+        self.reader = None
+        self.writer = None
+        self._plain_writer = None
+
+    async def connect(self):
+        """ Connect and read the server greeting.
+        """
+        context = ssl.create_default_context() if self.use_tls else None
+        self.reader, self.writer = await asyncio.wait_for(asyncio.open_connection(self.host, self.port, ssl=context), self.timeout)
+        code, response = await self.reply()
+        if code != 220:
+            self.close()
+            raise smtplib.SMTPConnectError(code, response)
+
+    async def reply(self):
+        """ Read a (multi-line) reply, return (code, message).
+        """
+        lines = []
+        while True:
+            try:
+                line = await asyncio.wait_for(self.reader.readline(), self.timeout)
+            except (asyncio.IncompleteReadError, ConnectionError) as e:
+                raise smtplib.SMTPServerDisconnected(str(e))
+            if not line:
+                raise smtplib.SMTPServerDisconnected('Connection unexpectedly closed')
+
+            lines.append(line[4:].strip())
+            if line[3:4] != b'-':
+                break
+
+        try:
+            code = int(line[:3])
+        except ValueError:
+            code = -1
+
+        return(code, b'\n'.join(lines))
+
+    def write(self, data):
+        if self.writer is None or self.writer.is_closing():
+            raise smtplib.SMTPServerDisconnected('Not connected')
+        self.writer.write(data)
+
+    async def command(self, line):
+        """ Send a command and return its reply.
+        """
+        self.write(line.encode('ascii') + b'\r\n')
+        await self.writer.drain()
+        return(await self.reply())
+
+    async def ehlo(self):
+        """ Send EHLO and record the ESMTP features advertised.
+        """
+        code, response = await self.command('EHLO ' + socket.getfqdn())
+        if code != 250:
+            raise smtplib.SMTPHeloError(code, response)
+
+        self.features = {}
+        for line in response.decode('latin-1').splitlines()[1:]:
+            feature, _, parameters = line.partition(' ')
+            self.features[feature.lower()] = parameters.strip()
+
+    async def starttls(self):
+        """ Upgrade the connection to TLS and repeat EHLO.
+        """
+        code, response = await self.command('STARTTLS')
+        if code != 220:
+            raise smtplib.SMTPResponseException(code, response)
+
+        context = ssl.create_default_context()
+        if hasattr(self.writer, 'start_tls'):
+            # Python 3.11+
+            await self.writer.start_tls(context, server_hostname=self.host)
+        else:
+            loop = asyncio.get_event_loop()
+            if not hasattr(loop, 'start_tls'):
+                raise smtplib.SMTPException('STARTTLS requires Python 3.7+, use use_tls=True (implicit TLS) instead.')
+            transport = await loop.start_tls(self.writer.transport, self.writer.transport.get_protocol(), context, server_hostname=self.host)
+            # The reader keeps receiving through the same protocol, only the writer
+            # changes transport. The plain writer is kept, collecting it would
+            # close the socket under the TLS transport.
+            self._plain_writer = self.writer
+            self.writer = asyncio.StreamWriter(transport, transport.get_protocol(), self.reader, loop)
+        await self.ehlo()
+
+    async def login(self, username, password):
+        """ Authenticate with AUTH PLAIN, or AUTH LOGIN when PLAIN is not advertised.
+        """
+        mechanisms = self.features.get('auth', '').upper().split()
+        if 'PLAIN' in mechanisms or 'LOGIN' not in mechanisms:
+            token = base64.b64encode('\0{}\0{}'.format(username, password).encode('utf-8')).decode('ascii')
+            code, response = await self.command('AUTH PLAIN ' + token)
+        else:
+            code, response = await self.command('AUTH LOGIN')
+            if code == 334:
+                code, response = await self.command(base64.b64encode(username.encode('utf-8')).decode('ascii'))
+            if code == 334:
+                code, response = await self.command(base64.b64encode(password.encode('utf-8')).decode('ascii'))
+
+        if code != 235:
+            raise smtplib.SMTPAuthenticationError(code, response)
+
+    async def sendmail(self, from_, to, chunks):
+        """ Send a message from bytes chunks (CRLF line endings) to a list of recipients.
+
+            Returns the recipients refused by the server, like smtplib.SMTP.sendmail().
+        """
+        commands = ['MAIL FROM:<{}>'.format(email.utils.parseaddr(from_)[1])]
+        commands.extend(['RCPT TO:<{}>'.format(email.utils.parseaddr(address)[1]) for address in to])
+        commands.append('DATA')
+
+        if 'pipelining' in self.features:
+            self.write(b''.join([command.encode('ascii') + b'\r\n' for command in commands]))
+            await self.writer.drain()
+            replies = [await self.reply() for _ in commands]
+        else:
+            replies = []
+            for command in commands:
+                replies.append(await self.command(command))
+                # Stop at a refused sender or when no recipient was accepted.
+                if replies[0][0] != 250 or (command == commands[-2] and all(code not in (250, 251) for code, _ in replies[1:])):
+                    break
+
+        code, response = replies[0]
+        if code != 250:
+            await self.reset(replies)
+            raise smtplib.SMTPSenderRefused(code, response, from_)
+
+        refused = {}
+        for address, (code, response) in zip(to, replies[1:]):
+            if code not in (250, 251):
+                refused[address] = (code, response)
+        if len(refused) == len(to):
+            await self.reset(replies)
+            raise smtplib.SMTPRecipientsRefused(refused)
+
+        code, response = replies[-1]
+        if code != 354:
+            await self.reset(replies)
+            raise smtplib.SMTPDataError(code, response)
+
+        # The end of data marker goes out with the last lines, a separate small
+        # write is held back by Nagle's algorithm until the previous one is acknowledged.
+        pending = b''
+        for data in dot_stuffed(chunks):
+            if pending:
+                self.write(pending)
+                await self.writer.drain()
+            pending = data
+        self.write(pending + b'.\r\n')
+        await self.writer.drain()
+
+        code, response = await self.reply()
+        if code != 250:
+            raise smtplib.SMTPDataError(code, response)
+
+        return(refused)
+
+    async def reset(self, replies):
+        """ Reset the transaction, a pipelined DATA that was accepted is ended first.
+        """
+        if replies[-1][0] == 354:
+            self.write(b'.\r\n')
+            await self.reply()
+        await self.command('RSET')
+
+    async def quit(self):
+        try:
+            await self.command('QUIT')
+        except (smtplib.SMTPException, OSError, asyncio.TimeoutError):
+            pass
+        self.close()
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        self.writer = None
+        self.reader = None
+
+
+class AsyncSMTPSender(object):
+    """ asyncio counterpart of SMTPSender.
+
+        async with AsyncSMTPSender(host, port, username, password, connections=4) as sender:
+            await sender.send(from_, to, message)
+            failures = await sender.send_many((from_, to, message) for ...)
+
+        At most connections messages are in flight at the same time.
+    """
+    def __init__(self, host='', port=25, username='', password='', starttls=True, use_tls=False, connections=1, max_messages=100, timeout=60):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.starttls = starttls and not use_tls
+        self.use_tls = use_tls
+        self.connections = connections
+        self.max_messages = max_messages
+        self.timeout = timeout
+        self._slots = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    def slots(self):
+        # Created lazily, an asyncio.Queue must be created inside the running loop on Python < 3.10.
+        if self._slots is None:
+            self._slots = asyncio.LifoQueue()
+            for _ in range(self.connections):
+                self._slots.put_nowait(None)
+        return(self._slots)
+
+    async def connect(self):
+        """ Return a new authenticated AsyncSMTP connection.
+        """
+        smtp = AsyncSMTP(self.host, self.port, use_tls=self.use_tls, timeout=self.timeout)
+        await smtp.connect()
+        await smtp.ehlo()
+        if self.starttls:
+            await smtp.starttls()
+        if self.username:
+            await smtp.login(self.username, self.password)
+        return(smtp)
+
+    async def send(self, from_, to, message):
+        """ Send a message (email.message.Message, str, bytes or iterable of bytes chunks).
+
+            Returns the recipients refused by the server.
+        """
+        if isinstance(message, Message):
+            message = message.as_bytes(policy=message.policy.clone(linesep='\r\n'))
+        elif isinstance(message, str):
+            message = EOL.sub('\r\n', message).encode('ascii')
+
+        if isinstance(message, bytes):
+            chunks = [message]
+            replayable = True
+        else:
+            chunks = iter(message)
+            replayable = False
+
+        slots = self.slots()
+        slot = await slots.get()
+        try:
+            if slot is not None and slot[1] >= self.max_messages:
+                await slot[0].quit()
+                slot = None
+
+            for attempt in range(2):
+                if slot is None:
+                    slot = [await self.connect(), 0]
+                try:
+                    refused = await slot[0].sendmail(from_, to, chunks)
+                    break
+                except smtplib.SMTPServerDisconnected:
+                    slot[0].close()
+                    slot = None
+                    if attempt or not replayable:
+                        raise
+                    logger.info('SMTP server disconnected, reconnecting.')
+                except smtplib.SMTPException:
+                    raise
+                except (Exception, asyncio.CancelledError):
+                    # Timeouts, cancellation or a chunk iterator failing halfway through DATA.
+                    slot[0].close()
+                    slot = None
+                    raise
+
+            slot[1] += 1
+        finally:
+            slots.put_nowait(slot)
+
+        return(refused)
+
+    async def send_many(self, messages):
+        """ Send (from_, to, message) tuples concurrently over the connections.
+
+            Returns a list of (index, exception) for the messages that failed.
+        """
+        failures = []
+        messages = iter(enumerate(messages))
+
+        async def worker():
+            for index, (from_, to, message) in messages:
+                try:
+                    await self.send(from_, to, message)
+                except (smtplib.SMTPException, OSError, asyncio.TimeoutError) as e:
+                    logger.warning('Message {} failed: {}'.format(index, e))
+                    failures.append((index, e))
+
+        await asyncio.gather(*[worker() for _ in range(self.connections)])
+        return(sorted(failures, key=lambda failure: failure[0]))
+
+    async def close(self):
+        """ Quit all open connections.
+        """
+        if self._slots is None:
+            return
+
+        slots = []
+        while not self._slots.empty():
+            slots.append(self._slots.get_nowait())
+
+        for slot in slots:
+            if slot is not None:
+                await slot[0].quit()
+            self._slots.put_nowait(None)
+
+
+async def async_deliver(from_, to, message, smtp_server='', smtp_port=25, smtp_username='', smtp_password='', sender=None):
+    """ Send a message with sender (an AsyncSMTPSender) or over a new SMTP connection.
+    """
+    if sender is None:
+        async with AsyncSMTPSender(smtp_server, smtp_port, smtp_username, smtp_password, max_messages=1) as sender:
+            return(await sender.send(from_, to, message))
+
+    return(await sender.send(from_, to, message))
+
+
+async def async_text_email(from_='',
+                           to=[],
+                           cc=None,
+                           bcc=None,
+                           subject='',
+                           body='',
+                           files=None,
+                           smtp_server='',
+                           smtp_port=25,
+                           smtp_username='',
+                           smtp_password='',
+                           sender=None):
+    """ asyncio counterpart of text_email(), pass sender (an AsyncSMTPSender) to reuse its connections.
+    """
+    message = text_message(from_=from_, to=to, cc=cc, subject=subject, body=body, files=files)
+    await async_deliver(from_, recipients(to, cc, bcc), message, smtp_server, smtp_port, smtp_username, smtp_password, sender)
+
+
+async def async_html_email(from_='',
+                           to=[],
+                           cc=None,
+                           bcc=None,
+                           subject='',
+                           text_body='',
+                           html_body='',
+                           files=None,
+                           images=[],
+                           smtp_server='',
+                           smtp_port=25,
+                           smtp_username='',
+                           smtp_password='',
+                           sender=None):
+    """ asyncio counterpart of html_email(), pass sender (an AsyncSMTPSender) to reuse its connections.
+    """
+    message = html_message(from_=from_, to=to, cc=cc, subject=subject, text_body=text_body, html_body=html_body, files=files, images=images)
+    await async_deliver(from_, recipients(to, cc, bcc), message, smtp_server, smtp_port, smtp_username, smtp_password, sender)
+
+
+class MailQueue(object):
+    """ Durable outbound mail spool backed by sqlite.
+
+        queue = MailQueue('~/mail_queue.sqlite')
+        queue.enqueue(from_, to, message)  # Returns immediately.
+
+        with SMTPSender(host, port, username, password, connections=4) as sender:
+            queue.drain(sender, rate_limits={'example.com': 2.0})
+
+        Messages are stored per recipient domain. drain() sends queued messages
+        with the sender's connections, retries transient failures with
+        exponential backoff (backoff * 2**attempts seconds, at most max_backoff)
+        and moves messages that fail permanently (5xx) or max_attempts times to
+        the 'dead' status, as are unexpected errors (e.g. a non-ASCII address).
+        rate_limits caps messages per second per domain. Refused recipients
+        are split off, the permanently refused (5xx) into a dead letter and
+        the temporarily refused into a message of their own that is retried.
+
+        Claimed messages are leased for lease seconds, a message still
+        'sending' after that was claimed by a worker that died and is
+        requeued by recover(). Several drain() workers may share a queue.
+    """
+    def __init__(self, path='~/mail_queue.sqlite', max_attempts=8, backoff=60, max_backoff=3600, lease=3600):
+        self.path = os.path.expanduser(path)
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.lease = lease
+
+        ensure_directory_exists(self.path, file=True)
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False, timeout=30)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('PRAGMA synchronous=NORMAL')
+        self._connection.execute("""
+            CREATE TABLE IF NOT EXISTS queue (
+                id INTEGER PRIMARY KEY,
+                sender TEXT,
+                recipients TEXT,
+                domain TEXT,
+                message BLOB,
+                status TEXT DEFAULT 'queued',
+                attempts INTEGER DEFAULT 0,
+                next_attempt REAL,
+                created REAL,
+                error TEXT,
+                claimed_at REAL
+            )""")
+        columns = [row[1] for row in self._connection.execute('PRAGMA table_info(queue)')]
+        if 'claimed_at' not in columns:
+            self._connection.execute('ALTER TABLE queue ADD COLUMN claimed_at REAL')
+        self._connection.execute('CREATE INDEX IF NOT EXISTS queue_next ON queue (status, next_attempt)')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def execute(self, sql, params=()):
+        with self._lock:
+            return(self._connection.execute(sql, params).fetchall())
+
+    def enqueue(self, from_, to, message):
+        """ Spool a message (Message, str, bytes or bytes chunks) for to, a list of recipients.
+
+            Returns the queue ids, one per recipient domain.
+        """
+        if isinstance(message, Message):
+            message = message.as_bytes(policy=message.policy.clone(linesep='\r\n'))
+        elif isinstance(message, str):
+            message = EOL.sub('\r\n', message).encode('ascii')
+        elif not isinstance(message, bytes):
+            message = b''.join(message)
+
+        domains = {}
+        for address in to:
+            domain = email.utils.parseaddr(address)[1].rpartition('@')[2].lower()
+            domains.setdefault(domain, []).append(address)
+
+        now = time.time()
+        ids = []
+        with self._lock:
+            with self._connection:
+                self._connection.execute('BEGIN')
+                for domain, addresses in domains.items():
+                    cursor = self._connection.execute('INSERT INTO queue (sender, recipients, domain, message, next_attempt, created) VALUES (?, ?, ?, ?, ?, ?)',
+                                                      (from_, json.dumps(addresses), domain, message, now, now))
+                    ids.append(cursor.lastrowid)
+
+        return(ids)
+
+    def claim(self, limit=100):
+        """ Mark up to limit due messages as 'sending' and return them.
+        """
+        now = time.time()
+        with self._lock:
+            with self._connection:
+                self._connection.execute('BEGIN IMMEDIATE')
+                rows = self._connection.execute("SELECT id, sender, recipients, domain, message, attempts FROM queue WHERE status = 'queued' AND next_attempt <= ? ORDER BY next_attempt LIMIT ?",
+                                                (now, limit)).fetchall()
+                self._connection.executemany("UPDATE queue SET status = 'sending', claimed_at = ? WHERE id = ?", [(now, row[0]) for row in rows])
+
+        return(rows)
+
+    def done(self, id_):
+        """ Remove a sent message.
+        """
+        self.execute('DELETE FROM queue WHERE id = ?', (id_,))
+
+    def defer(self, id_, when):
+        """ Put a claimed message back without counting an attempt.
+        """
+        self.execute("UPDATE queue SET status = 'queued', next_attempt = ? WHERE id = ?", (when, id_))
+
+    def failed(self, id_, attempts, error, permanent=False):
+        """ Schedule a retry with exponential backoff, or move the message to 'dead'.
+        """
+        attempts += 1
+        if permanent or attempts >= self.max_attempts:
+            logger.warning('Dead letter {}: {}'.format(id_, error))
+            self.execute("UPDATE queue SET status = 'dead', attempts = ?, error = ? WHERE id = ?", (attempts, str(error), id_))
+        else:
+            delay = min(self.backoff * 2 ** (attempts - 1), self.max_backoff)
+            self.execute("UPDATE queue SET status = 'queued', attempts = ?, next_attempt = ?, error = ? WHERE id = ?", (attempts, time.time() + delay, str(error), id_))
+
+    def refused(self, id_, attempts, recipients):
+        """ Split recipients refused by the server ({address: (code, response)}) off a message.
+
+            The accepted recipients are done. Permanently refused (5xx)
+            recipients become a dead letter, the temporarily refused ones a
+            new message that is retried. Returns the new ids.
+        """
+        permanent = {address: value for address, value in recipients.items() if value[0] >= 500}
+        temporary = {address: value for address, value in recipients.items() if value[0] < 500}
+
+        split = []
+        with self._lock:
+            with self._connection:
+                self._connection.execute('BEGIN')
+                for group in [permanent, temporary]:
+                    if group:
+                        cursor = self._connection.execute("INSERT INTO queue (sender, recipients, domain, message, status, attempts, next_attempt, created, claimed_at) "
+                                                          "SELECT sender, ?, domain, message, 'sending', attempts, next_attempt, created, ? FROM queue WHERE id = ?",
+                                                          (json.dumps(list(group)), time.time(), id_))
+                        split.append((cursor.lastrowid, group))
+                self._connection.execute('DELETE FROM queue WHERE id = ?', (id_,))
+
+        for new_id, group in split:
+            self.failed(new_id, attempts, smtplib.SMTPRecipientsRefused(group), group is permanent)
+        return([new_id for new_id, _ in split])
+
+    def recover(self):
+        """ Requeue messages left 'sending' longer than the lease, by a worker that died.
+        """
+        self.execute("UPDATE queue SET status = 'queued' WHERE status = 'sending' AND (claimed_at IS NULL OR claimed_at < ?)", (time.time() - self.lease,))
+
+    def requeue_dead(self):
+        """ Give dead letters another max_attempts attempts.
+        """
+        self.execute("UPDATE queue SET status = 'queued', attempts = 0, next_attempt = ? WHERE status = 'dead'", (time.time(),))
+
+    def dead(self):
+        """ Return the dead letters as (id, sender, recipients, error) tuples.
+        """
+        return([(id_, sender, json.loads(recipients), error) for id_, sender, recipients, error in self.execute("SELECT id, sender, recipients, error FROM queue WHERE status = 'dead'")])
+
+    def stats(self):
+        """ Return the number of messages per status.
+        """
+        return(dict(self.execute('SELECT status, COUNT(*) FROM queue GROUP BY status')))
+
+    def drain(self, sender, rate_limits=None, default_rate=None, forever=False, poll_interval=1.0, batch_size=100):
+        """ Send the queued messages with sender (an SMTPSender), over sender.connections connections.
+
+            Returns when nothing is due, or keeps polling every poll_interval
+            seconds with forever=True. Returns the number of messages sent.
+        """
+        rate_limits = rate_limits or {}
+        next_allowed = {}
+        sent = [0]
+        self.recover()
+
+        def send(row):
+            id_, from_, to, domain, message, attempts = row
+            try:
+                refused = sender.send(from_, json.loads(to), message)
+            except smtplib.SMTPRecipientsRefused as e:
+                self.refused(id_, attempts, e.recipients)
+            except smtplib.SMTPResponseException as e:
+                self.failed(id_, attempts, e, e.smtp_code >= 500)
+            except (smtplib.SMTPException, OSError) as e:
+                self.failed(id_, attempts, e)
+            except Exception as e:
+                # E.g. a non-ASCII address, retrying will not help.
+                logger.exception('Unexpected error sending {}'.format(id_))
+                self.failed(id_, attempts, e, permanent=True)
+            else:
+                if refused:
+                    self.refused(id_, attempts, refused)
+                else:
+                    self.done(id_)
+                sent[0] += 1
+
+        # Messages held back by the rate limits are due again before this time.
+        deferred = 0
+        with concurrent.futures.ThreadPoolExecutor(max_workers=sender.connections) as executor:
+            while True:
+                rows = self.claim(batch_size)
+                if not rows:
+                    self.recover()
+                    now = time.time()
+                    if deferred > now:
+                        time.sleep(min(poll_interval, deferred - now))
+                    elif forever:
+                        time.sleep(poll_interval)
+                    else:
+                        break
+                    continue
+
+                futures = []
+                now = time.time()
+                for row in rows:
+                    domain = row[3]
+                    rate = rate_limits.get(domain, default_rate)
+                    if rate:
+                        when = next_allowed.get(domain, now)
+                        if when > now:
+                            self.defer(row[0], when)
+                            deferred = max(deferred, when)
+                            continue
+                        next_allowed[domain] = now + 1.0 / rate
+                    futures.append(executor.submit(send, row))
+
+                for future in futures:
+                    future.result()
+
+        return(sent[0])
+
+    def close(self):
+        self._connection.close()
 
 
 if __name__ == '__main__':
@@ -48,9 +48,9 @@ def valid_filename(directory, filename=None, ascii=False):
         directory = os.path.dirname(directory)
 
     if ascii:
-        filename = unidecode(unicode(filename))
+        filename = unidecode(filename)
         filename = ' '.join(filename.splitlines()).strip()
-        filename = filename.decode('ascii', 'ignore')
+        filename = filename.encode('ascii', 'ignore').decode('ascii')
 
     # Allow for directories.
     items = {item: True for item in os.listdir(directory)}
@@ -1,9 +1,28 @@
 """ Utility library for image-processing tools.
 """
+from array import array
+import concurrent.futures
+import itertools
+import json
 import math
+import operator
+import os
+import shutil
+import tempfile
+import time
 
 from PIL import Image, ImageDraw
 
+from .util_fs import ensure_directory_exists
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Bytes of a mode '1' image converted to 'L' (0 or 255) to black pixel counts (1 or 0).
+BLACK = bytes([1] + [0] * 255)
+
 
 hex_map = {
     0: '0',
@@ -37,9 +56,150 @@ def px(mm, dpi):
     return(int(round((mm / 25.4) * dpi)))
 
 
+def normalize(rect):
+    """ Return the rectangle (x1, y1, x2, y2) with x1 <= x2 and y1 <= y2.
+    """
+    x1, y1, x2, y2 = rect
+    x1, x2 = ((x1, x2), (x2, x1))[x1 > x2]
+    y1, y2 = ((y1, y2), (y2, y1))[y1 > y2]
+    return(x1, y1, x2, y2)
+
+
+class ImageAnalysis(object):
+    """ A binarized image with a summed-area table, for repeated ratio_black() calls.
+
+        analysis = ImageAnalysis(Image.open(path))
+        y1 = top_line(analysis)
+        fp = fingerprint(analysis, (20, 20, w-20, 250))
+
+        The image is converted to mode '1' once, after which the number of
+        black pixels in any rectangle takes four lookups. Pass an analysis
+        wherever an image is passed to ratio_black(), ratio_white(),
+        fingerprint(), top_line() etc. Like crop(), pixels outside of the
+        image count as black. The table uses NumPy when installed.
+
+        ImageAnalysis.open(path, size) decodes at reduced resolution (see
+        open_reduced()), to_full() and from_full() map rectangles between
+        the analysis and the full resolution image.
+    """
+    def __init__(self, image, full_size=None):
+        self.image = image
+        self.size = image.size
+        self.full_size = full_size or image.size
+        width, height = image.size
+        self.scale = (self.full_size[0] / float(width or 1), self.full_size[1] / float(height or 1))
+
+        bw = image.convert('1')
+        if numpy is not None:
+            black = ~numpy.asarray(bw, dtype=bool)
+            table = numpy.zeros((height + 1, width + 1), dtype=numpy.int64)
+            table[1:, 1:] = black.cumsum(axis=0, dtype=numpy.int64).cumsum(axis=1)
+            self.table = table
+        else:
+            data = bw.convert('L').tobytes().translate(BLACK)
+            row = array('q', [0] * (width + 1))
+            table = [row]
+            for y in range(height):
+                counts = itertools.accumulate(data[y * width:(y + 1) * width])
+                row = array('q', itertools.chain([0], map(operator.add, row[1:], counts)))
+                table.append(row)
+            self.table = table
+
+    @classmethod
+    def open(cls, path, size=(1240, 1754), mode='L'):
+        """ Return the analysis of an image file decoded at about size, see open_reduced().
+        """
+        image, full_size = open_reduced(path, size, mode)
+        return(cls(image, full_size))
+
+    def to_full(self, rect):
+        """ Map a rectangle in the analysis to full resolution coordinates.
+        """
+        x1, y1, x2, y2 = rect
+        sx, sy = self.scale
+        width, height = self.full_size
+        return(int(round(x1 * sx)), int(round(y1 * sy)), min(int(round(x2 * sx)), width), min(int(round(y2 * sy)), height))
+
+    def from_full(self, rect):
+        """ Map a full resolution rectangle to the analysis.
+        """
+        x1, y1, x2, y2 = rect
+        sx, sy = self.scale
+        return(int(round(x1 / sx)), int(round(y1 / sy)), int(round(x2 / sx)), int(round(y2 / sy)))
+
+    def crop(self, box):
+        return(self.image.crop(box))
+
+    def count_black(self, rect):
+        """ Return the number of black pixels in the rectangle.
+        """
+        x1, y1, x2, y2 = normalize(rect)
+        width, height = self.size
+        pixels = (x2 - x1) * (y2 - y1)
+
+        # Clip to the image, the rest is black.
+        cx1, cx2 = min(max(x1, 0), width), min(max(x2, 0), width)
+        cy1, cy2 = min(max(y1, 0), height), min(max(y2, 0), height)
+        inside = (cx2 - cx1) * (cy2 - cy1)
+        table = self.table
+        black = int(table[cy2][cx2] - table[cy1][cx2] - table[cy2][cx1] + table[cy1][cx1])
+
+        return(black + pixels - inside)
+
+    def ratio_black(self, rect):
+        """ Return the ratio of black pixels in the rectangle, see ratio_black().
+        """
+        x1, y1, x2, y2 = normalize(rect)
+        pixels = (x2 - x1) * (y2 - y1)
+        if pixels == 0:
+            return(1.0)
+        return(self.count_black((x1, y1, x2, y2)) / float(pixels))
+
+    def ratio_white(self, rect):
+        """ Return the ratio of white pixels in the rectangle, see ratio_white().
+        """
+        x1, y1, x2, y2 = normalize(rect)
+        pixels = (x2 - x1) * (y2 - y1)
+        if pixels == 0:
+            return(1.0)
+        return(1.0 - self.count_black((x1, y1, x2, y2)) / float(pixels))
+
+
+def open_reduced(path, size=(1240, 1754), mode='L'):
+    """ Open an image file decoded at no less than size, return (image, full size).
+
+        JPEG files use draft(), the decoder scales by 1/2, 1/4 or 1/8 (DCT
+        scaling) and can decode straight to mode, which is much faster and
+        smaller than a full decode. Other formats are reduce()d by an
+        integer factor after decoding, bilevel (e.g. G4 TIFF) and palette
+        images are converted to mode first.
+    """
+    image = Image.open(path)
+    full_size = image.size
+
+    if image.format == 'JPEG':
+        image.draft(mode, size)
+    else:
+        factor = min(full_size[0] // size[0], full_size[1] // size[1])
+        if factor > 1:
+            # reduce() does not support bilevel, palette and 16 bit images.
+            if image.mode in ['1', 'P', 'PA']:
+                image = image.convert(mode)
+            elif image.mode.startswith('I;16'):
+                image = image.convert('I')
+            image = image.reduce(factor)
+
+    return(image, full_size)
+
+
 def ratio_black(image, rect):
     """ Return the ratio of black pixels to non-black pixels in the rectangle in the image.
+
+        image may be an ImageAnalysis.
     """
+    if isinstance(image, ImageAnalysis):
+        return(image.ratio_black(rect))
+
     x1, y1, x2, y2 = rect
 
     # Normalize the rectangle.
@@ -57,7 +217,12 @@ def ratio_black(image, rect):
 
 def ratio_white(image, rect):
     """ Return the ratio of white pixels to non-white pixels in the rectangle in the image.
+
+        image may be an ImageAnalysis.
     """
+    if isinstance(image, ImageAnalysis):
+        return(image.ratio_white(rect))
+
     x1, y1, x2, y2 = rect
 
     # Normalize the rectangle.
@@ -147,7 +312,7 @@ def scale_width(image, new_width=1600):
     width, height = image.size
     ratio = height / float(width)
     new_height = int(math.floor(ratio * new_width))
-    resized_image = image.resize((new_width, new_height), Image.ANTIALIAS)
+    resized_image = image.resize((new_width, new_height), Image.LANCZOS)
     return(resized_image)
 
 
@@ -272,68 +437,138 @@ def right_line(image, delta=80):
     return(max(values.values() or [width]))
 
 
-def trim_whitespace(image):
-    """ Trim whitespace around an image.
+def black_profiles(image, level=128):
+    """ Return the black pixel counts of the rows and columns of an image, (rows, columns).
+
+        Pixels darker than level (grey 0-255) are black, the image is not
+        dithered. Dithering a whole page turns light grey backgrounds into a
+        few percent black in every line. image may be an ImageAnalysis.
     """
+    if isinstance(image, ImageAnalysis):
+        image = image.image
+
     width, height = image.size
+    grey = image.convert('L')
+    if numpy is not None:
+        black = numpy.asarray(grey) < level
+        return(black.sum(axis=1).tolist(), black.sum(axis=0).tolist())
+
+    # Box filter means of the thresholded image, 255.0 for an all black line.
+    inverted = grey.point(lambda value: 255 if value < level else 0).convert('F')
+    rows = array('f', inverted.resize((1, height), Image.BOX).tobytes())
+    columns = array('f', inverted.resize((width, 1), Image.BOX).tobytes())
+    return([int(round(value * width / 255.0)) for value in rows], [int(round(value * height / 255.0)) for value in columns])
+
+
+def trim_box(image, threshold=0.01, start=5, margin=10, level=128, dither=False):
+    """ Return the box (x1, y1, x2, y2) of trim_whitespace().
+
+        Scanning starts start pixels in from each edge for the first line
+        (row or column) with a ratio of black pixels >= threshold, the box is
+        grown by margin pixels. An edge without such a line is not trimmed.
+
+        Pixels darker than level are black (see black_profiles()), so grey
+        content lighter than level is whitespace. With dither=True each line
+        is dithered on its own instead, as trim_whitespace() used to: a grey
+        line then has a ratio of black pixels that grows with its darkness,
+        e.g. a light grey background is content. That is much slower.
+    """
+    if isinstance(image, ImageAnalysis) and dither:
+        image = image.image
 
-    # Top line.
-    for y1 in range(5, height - 1):
-        if ratio_black(image, (0, y1, width, y1 + 1)) >= 0.01:
-            break
-    else:
-        y1 = 0
+    width, height = image.size
+    if dither:
+        def row(y):
+            return(ratio_black(image, (0, y, width, y + 1)))
 
-    # Bottom line.
-    for y2 in range(height - 5, 1, -1):
-        if ratio_black(image, (0, y2, width, y2 - 1)) >= 0.01:
-            break
+        def column(x):
+            return(ratio_black(image, (x, 0, x + 1, height)))
     else:
-        y2 = height
+        rows, columns = black_profiles(image, level)
 
-    # Left line.
-    for x1 in range(5, width - 1):
-        if ratio_black(image, (x1, 0, x1 + 1, height)) >= 0.01:
-            break
-    else:
-        x1 = 0
+        def row(y):
+            return(rows[y] / float(width))
 
-    # Right line.
-    for x2 in range(width - 5, 1, -1):
-        if ratio_black(image, (x2, 0, x2 - 1, height)) >= 0.01:
-            break
-    else:
-        x2 = width
+        def column(x):
+            return(columns[x] / float(height))
 
-    y1 = max(y1 - 10, 0)
-    y2 = min(y2 + 10, height)
-    x1 = max(x1 - 10, 0)
-    x2 = min(x2 + 10, width)
+    def first(ratio, indexes):
+        for index in indexes:
+            if ratio(index) >= threshold:
+                return(index)
+        return(None)
 
-    image = image.crop((x1, y1, x2, y2))
+    y1 = first(row, range(start, height - 1))
+    y1 = 0 if y1 is None else y1
+    y2 = first(row, range(height - start - 1, 0, -1))
+    y2 = height if y2 is None else y2 + 1
+    x1 = first(column, range(start, width - 1))
+    x1 = 0 if x1 is None else x1
+    x2 = first(column, range(width - start - 1, 0, -1))
+    x2 = width if x2 is None else x2 + 1
 
-    return(image)
+    y1 = max(y1 - margin, 0)
+    y2 = min(y2 + margin, height)
+    x1 = max(x1 - margin, 0)
+    x2 = min(x2 + margin, width)
 
+    return(x1, y1, x2, y2)
 
-def alt_trim_whitespace(image, delta=80):
-    """ Alternative algorithm to trim whitespace around an image.
 
-        Ignore speckels in the image.
+def trim_whitespace(image, level=128, dither=False):
+    """ Trim whitespace around an image.
+
+        Uses the row and column black pixel profiles, see trim_box().
     """
-    width, height = image.size
+    return(image.crop(trim_box(image, level=level, dither=dither)))
+
+
+def alt_trim_box(image, delta=80):
+    """ Return the box (x1, y1, x2, y2) of alt_trim_whitespace().
 
+        Pass an ImageAnalysis to avoid a crop per delta sized block.
+    """
     x1 = left_line(image, delta)
     x2 = right_line(image, delta)
     y1 = top_line(image, delta)
     y2 = bottom_line(image, delta)
 
-    # y1 = max(y1 - 10, 0)
-    # y2 = min(y2 + 10, height)
-    # x1 = max(x1 - 10, 0)
-    # x2 = min(x2 + 10, width)
+    return(x1, y1, x2, y2)
+
 
-    image = image.crop((x1, y1, x2, y2))
+def page_box(path, size=(1240, 1754), alt=False, delta=80):
+    """ Return trim_box() (alt_trim_box() when alt) of an image file, in full resolution coordinates.
 
+        The image is analysed at reduced resolution (see ImageAnalysis.open()),
+        pixel distances are scaled to match. Thin lines fade when
+        downscaled, so pick size no smaller than needed to see the content.
+    """
+    analysis = ImageAnalysis.open(path, size)
+    scale = max(analysis.scale)
+    if alt:
+        box = alt_trim_box(analysis, max(int(round(delta / scale)), 1))
+    else:
+        box = trim_box(analysis, start=max(int(round(5 / scale)), 1), margin=int(round(10 / scale)))
+
+    return(analysis.to_full(box))
+
+
+def alt_trim_whitespace(image, delta=80):
+    """ Alternative algorithm to trim whitespace around an image.
+
+        Ignore speckels in the image.
+    """
+    return(image.crop(alt_trim_box(image, delta)))
+
+
+def crop_image(image, min_size=50):
+    """ Trim whitespace around an image, unless that leaves min_size pixels or less.
+    """
+    trimmed = trim_whitespace(image)
+
+    width, height = trimmed.size
+    if width > min_size and height > min_size:
+        return(trimmed)
     return(image)
 
 
@@ -356,3 +591,151 @@ def upright(image):
         image = image.rotate(90, expand=True)
 
     return(image)
+
+
+# Named operations of process_images(), image -> image.
+OPERATIONS = {
+    'crop': crop_image,
+    'trim_whitespace': trim_whitespace,
+    'alt_trim_whitespace': alt_trim_whitespace,
+    'scale_width': scale_width,
+    'upright': upright,
+    'make_portrait': make_portrait,
+}
+
+
+def operation(op):
+    """ Return (name, function, kwargs) of a process_images() operation.
+
+        op is a name in OPERATIONS, a function, or a (name or function, kwargs) tuple.
+    """
+    kwargs = {}
+    if isinstance(op, tuple):
+        op, kwargs = op
+    if callable(op):
+        return(op.__name__, op, kwargs)
+    return(op, OPERATIONS[op], kwargs)
+
+
+def process_image(src, dst, operations):
+    """ Apply operations to the image src and save it to dst, in a worker process.
+
+        dst is written to a temporary file and renamed, it is never left half
+        written. Returns {'path': src, 'timings': {stage: seconds}, 'error': str or None}.
+    """
+    timings = {}
+    try:
+        start = time.time()
+        image = Image.open(src)
+        format_ = image.format
+        image.load()
+        timings['open'] = time.time() - start
+
+        for op in operations:
+            name, function, kwargs = operation(op)
+            start = time.time()
+            image = function(image, **kwargs)
+            timings[name] = timings.get(name, 0.0) + time.time() - start
+
+        start = time.time()
+        directory, filename = os.path.split(dst)
+        fd, tmp = tempfile.mkstemp(prefix='.' + filename, dir=directory or '.')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                image.save(f, format=format_)
+            # mkstemp() creates the file 0600, keep the permissions of the source.
+            shutil.copymode(src, tmp)
+            os.replace(tmp, dst)
+        except BaseException:
+            os.remove(tmp)
+            raise
+        timings['save'] = time.time() - start
+
+    except Exception as e:
+        return({'path': src, 'timings': timings, 'error': '{}: {}'.format(type(e).__name__, e)})
+
+    return({'path': src, 'timings': timings, 'error': None})
+
+
+def _process_image(args):
+    return(process_image(*args))
+
+
+def process_images(paths, dst=None, operations=['crop'], src=None, workers=None, chunk_size=8, manifest='.process_images.json'):
+    """ Apply operations to many images with a process pool.
+
+        Outputs go to dst, in the directory structure of the paths relative
+        to src (the basename without src), in place when dst is None.
+        Operations are names in OPERATIONS, module level functions taking
+        and returning an image, or (operation, kwargs) tuples, e.g.
+        ['upright', 'crop', ('scale_width', {'new_width': 1200})].
+
+        Inputs already processed with the same operations and unchanged
+        since (mtime and size, recorded in the manifest file) are skipped.
+        A relative manifest is in dst, src or, for in place processing, the
+        common directory of the paths. Tasks are handed to the workers
+        chunk_size at a time.
+
+        Returns {'processed': n, 'skipped': n, 'failed': n, 'errors': {path: error},
+                 'seconds': s, 'rate': images/s, 'stages': {stage: total seconds}}.
+    """
+    start = time.time()
+    signature = json.dumps([[name, kwargs] for name, function, kwargs in map(operation, operations)], sort_keys=True)
+    paths = list(paths)
+    if dst or src:
+        directory = os.path.expanduser(dst or src)
+    elif paths:
+        directory = os.path.commonpath([os.path.dirname(os.path.abspath(path)) for path in paths])
+    else:
+        # Nothing to process, the manifest is not written.
+        directory = '.'
+    manifest_path = os.path.join(directory, os.path.expanduser(manifest))
+    try:
+        with open(manifest_path) as f:
+            done = json.load(f)
+    except (IOError, ValueError):
+        done = {}
+
+    def output(path):
+        if dst is None:
+            return(path)
+        name = os.path.relpath(path, src) if src else os.path.basename(path)
+        return(ensure_directory_exists(os.path.join(dst, name), file=True))
+
+    stats = {'processed': 0, 'skipped': 0, 'failed': 0, 'errors': {}, 'stages': {}}
+    tasks = []
+    for path in paths:
+        stat = os.stat(path)
+        record = done.get(path)
+        if record and record['operations'] == signature and record['mtime'] == stat.st_mtime and record['size'] == stat.st_size and os.path.exists(output(path)):
+            stats['skipped'] += 1
+        else:
+            tasks.append((path, output(path), operations))
+
+    def save_manifest():
+        tmp = manifest_path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(done, f)
+        os.replace(tmp, manifest_path)
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        for result in executor.map(_process_image, tasks, chunksize=chunk_size):
+            for stage, seconds in result['timings'].items():
+                stats['stages'][stage] = stats['stages'].get(stage, 0.0) + seconds
+            if result['error']:
+                stats['failed'] += 1
+                stats['errors'][result['path']] = result['error']
+                continue
+
+            # Stat after the write, an in place output is the next input.
+            stat = os.stat(result['path'])
+            done[result['path']] = {'operations': signature, 'mtime': stat.st_mtime, 'size': stat.st_size}
+            stats['processed'] += 1
+            if stats['processed'] % 1000 == 0:
+                save_manifest()
+
+    if stats['processed']:
+        save_manifest()
+    stats['seconds'] = time.time() - start
+    stats['rate'] = stats['processed'] / (stats['seconds'] or 1)
+    return(stats)
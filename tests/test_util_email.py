@@ -0,0 +1,40 @@
+import unittest
+
+from lcutil.util_email import decode_header_value, email_metadata, iter_parts
+
+
+class EmailMetadataTest(unittest.TestCase):
+
+    def test_raw_utf8_headers(self):
+        data = 'From: "Jürgen Müller" <j@example.de>\r\nSubject: Grüße aus Köln\r\n\r\nbody\r\n'.encode('utf-8')
+        metadata = email_metadata(data)
+        self.assertEqual(metadata['subject'], 'Grüße aus Köln')
+        self.assertEqual(metadata['from'], [('Jürgen Müller', 'j@example.de')])
+
+    def test_raw_latin1_header(self):
+        data = 'Subject: Grüße =?utf-8?q?aus_K=C3=B6ln?=\r\n\r\n'.encode('latin-1')
+        self.assertEqual(email_metadata(data)['subject'], 'Grüße aus Köln')
+
+    def test_str_message(self):
+        self.assertEqual(email_metadata('Subject: héllo\n\n')['subject'], 'héllo')
+
+    def test_encoded_words(self):
+        self.assertEqual(decode_header_value('=?iso-8859-1?q?caf=E9?='), 'café')
+
+
+class IterPartsTest(unittest.TestCase):
+
+    def test_nested_boundary_extends_outer(self):
+        data = (b'Content-Type: multipart/mixed; boundary="b1"\r\n\r\n'
+                b'--b1\r\nContent-Type: multipart/alternative; boundary="b1-alt"\r\n\r\n'
+                b'--b1-alt\r\nContent-Type: text/plain\r\n\r\nplain\r\n'
+                b'--b1-alt\r\nContent-Type: text/html\r\n\r\n<p>html</p>\r\n'
+                b'--b1-alt--\r\n'
+                b'--b1 \r\nContent-Type: application/octet-stream\r\n\r\nxyz\r\n'
+                b'--b1--\r\n')
+        parts = [(part.headers.get_content_type(), part.depth, bytes(part.payload)) for part in iter_parts(data)]
+        self.assertEqual(parts, [('text/plain', 2, b'plain'), ('text/html', 2, b'<p>html</p>'), ('application/octet-stream', 1, b'xyz')])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,37 @@
+import unittest
+
+from PIL import Image, ImageDraw
+
+from lcutil.util_image import trim_box
+
+
+def page(fill, background=255):
+    """ A 600x800 page with a 200x300 block at (200, 250).
+    """
+    image = Image.new('L', (600, 800), background)
+    ImageDraw.Draw(image).rectangle((200, 250, 399, 549), fill=fill)
+    return(image)
+
+
+class TrimBoxTest(unittest.TestCase):
+
+    def test_black_block(self):
+        self.assertEqual(trim_box(page(0)), (190, 240, 410, 560))
+        self.assertEqual(trim_box(page(0), dither=True), (190, 240, 410, 560))
+
+    def test_mid_grey_block(self):
+        # Lighter than level is whitespace, unless each line is dithered.
+        self.assertEqual(trim_box(page(140)), (0, 0, 600, 800))
+        self.assertEqual(trim_box(page(140), level=160), (190, 240, 410, 560))
+        self.assertEqual(trim_box(page(140), dither=True), (190, 240, 410, 560))
+
+    def test_grey_background(self):
+        self.assertEqual(trim_box(page(0, background=200)), (190, 240, 410, 560))
+        self.assertEqual(trim_box(page(0, background=200), level=220), (0, 0, 600, 800))
+
+    def test_blank(self):
+        self.assertEqual(trim_box(page(255)), (0, 0, 600, 800))
+
+
+if __name__ == '__main__':
+    unittest.main()